@@ -1,18 +1,31 @@
 import streamlit as st
 import tempfile
+import os
+import shutil
 import pandas as pd
-import sqlite3
 import time
 import re
 
 # Import custom modules for PDF extraction, AI processing, and database operations
-from grading_utils import extract_text_from_pdf
-from openai_utils import generate_teaching_material, grade_assignment
+from pdf_guard import extract_text_guarded, PDFExtractionError, PDF_MAX_BYTES
+from openai_utils import (
+    generate_teaching_material, grade_assignment_routed,
+    GRADING_MODEL, GRADING_PROMPT_VERSION, ROUTER_ENABLED, ROUTER_CHEAP_MODEL,
+    content_hash, current_routing_versions,
+    get_coalescing_stats, get_routing_stats
+)
+from regrade import plan_regrade, run_regrade
+from scheduler import grading_scheduler
 from database import (
     insert_record, create_students_table,
     delete_latest_record, delete_record_by_id,
-    clear_students_table, get_all_records
+    clear_students_table, get_all_records,
+    get_latest_record, search_records, count_stale_records,
+    soft_delete_records, restore_records, delete_records_matching,
+    purge_deleted_records, create_backup, refresh_snapshot, get_snapshot_time,
+    get_auto_vacuum_mode, enable_incremental_vacuum
 )
+from maintenance import start_maintenance_scheduler, run_maintenance_cycle
 
 # Configure Streamlit page settings for wide layout
 st.set_page_config(page_title="Document Analyzer for Teachers", layout="wide")
@@ -38,6 +51,8 @@ if "last_record_id" not in st.session_state:
 
 # Create database table if it doesn't exist
 create_students_table()
+# Start background purge / incremental vacuum job (once per process)
+start_maintenance_scheduler()
 
 # Application title
 st.title("📚 Document Analyzer for Teachers")
@@ -59,15 +74,6 @@ def validate_email(email):
         return bool(email_pattern.match(email))
     return False
 
-# Function to retrieve the most recently added record from database
-def get_latest_record():
-    conn = sqlite3.connect("students.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM students ORDER BY id DESC LIMIT 1")
-    record = cursor.fetchone()
-    conn.close()
-    return record
-
 # -------------------------------
 # 🔐 Admin Login + Panel (Sidebar)
 # -------------------------------
@@ -141,10 +147,13 @@ def display_scrollable_dataframe(data, column_names):
 # -------------------------------
 if st.session_state["admin_logged_in"]:
     st.subheader("🛠️ Admin Panel")
+    # Set by every admin write below, so the table at the bottom reads the live database in this run
+    records_changed = False
 
     # Button to delete the most recent record
     if st.button("🗑️ Delete Latest Record"):
         delete_latest_record()
+        records_changed = True
         st.success("✅ Deleted latest record.")
 
     # Input field and button to delete a specific record by ID
@@ -152,6 +161,7 @@ if st.session_state["admin_logged_in"]:
     if st.button("❌ Delete Specific Record"):
         if record_id.isdigit():
             delete_record_by_id(int(record_id))
+            records_changed = True
             st.success(f"✅ Deleted record with ID {record_id}.")
         else:
             st.warning("⚠️ Please enter a valid numeric ID.")
@@ -159,11 +169,148 @@ if st.session_state["admin_logged_in"]:
     # Button to clear all records from the database
     if st.button("💣 Clear Entire Table"):
         clear_students_table()
+        records_changed = True
         st.success("✅ All records deleted.")
 
+    # Bulk operations: several IDs at once or everything matching a filter
+    # Deletes are soft (recoverable) until the purge job removes them
+    st.subheader("🧹 Bulk Operations")
+    bulk_ids = st.text_input("Record IDs (comma separated)")
+    parsed_ids = [int(part) for part in bulk_ids.split(",") if part.strip().isdigit()]
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("🗑️ Delete These IDs"):
+            if parsed_ids:
+                count = soft_delete_records(parsed_ids)
+                records_changed = True
+                st.success(f"✅ Deleted {count} records.")
+            else:
+                st.warning("⚠️ Please enter one or more numeric IDs.")
+    with col2:
+        if st.button("↩️ Restore These IDs"):
+            if parsed_ids:
+                count = restore_records(parsed_ids)
+                records_changed = True
+                st.success(f"✅ Restored {count} records.")
+            else:
+                st.warning("⚠️ Please enter one or more numeric IDs.")
+
+    filter_email = st.text_input("Filter by teacher email")
+    filter_student = st.text_input("Filter by student name")
+    filter_grade = st.text_input("Filter by grade")
+    if st.button("🗑️ Delete Matching Records"):
+        if filter_email or filter_student or filter_grade:
+            count = delete_records_matching(filter_email or None, filter_student or None, filter_grade or None)
+            records_changed = True
+            st.success(f"✅ Deleted {count} matching records.")
+        else:
+            st.warning("⚠️ Please enter at least one filter.")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("🔥 Purge Deleted Records Now"):
+            count = purge_deleted_records()
+            st.success(f"✅ Permanently removed {count} records.")
+    with col2:
+        if st.button("🧰 Run Maintenance"):
+            count = run_maintenance_cycle()
+            st.success(f"✅ Maintenance finished ({count} expired records purged).")
+
+    # Databases created before incremental vacuum need a one-time full VACUUM to switch;
+    # it rewrites the whole file and blocks grading while it runs, so it is never automatic
+    if get_auto_vacuum_mode() != "incremental":
+        st.warning("⚠️ This database does not free deleted pages yet; scheduled maintenance cannot shrink it.")
+        if st.button("🗜️ Enable Incremental Vacuum (one-time full VACUUM)"):
+            with st.spinner("Rewriting the database file..."):
+                enable_incremental_vacuum()
+            st.success("✅ Incremental vacuum enabled.")
+
+    # Online backup and the read-only snapshot the full records table can be read from
+    # (both also run on a schedule, see maintenance.py)
+    st.subheader("💾 Backup & Snapshot")
+    snapshot_time = get_snapshot_time()
+    st.write(f"Read snapshot last refreshed: {snapshot_time:%Y-%m-%d %H:%M:%S}" if snapshot_time
+             else "No read snapshot yet; reads use the live database.")
+    # Off by default: the snapshot can be minutes old, so edits above would not show up in it
+    use_snapshot = st.checkbox("Read full records table from snapshot", value=False,
+                               help="Takes load off the live database; changes since the last refresh are not shown.")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 Create Backup Now"):
+            progress_bar = st.progress(0.0)
+            backup_path = create_backup(progress=lambda done, total: progress_bar.progress(done / total if total else 1.0))
+            st.success(f"✅ Backup written to {backup_path}")
+    with col2:
+        if st.button("📸 Refresh Snapshot"):
+            refresh_snapshot()
+            st.success("✅ Snapshot refreshed.")
+
+    # Full-text search over remarks and submission text (index-backed)
+    st.subheader("🔎 Search Records")
+    search_query = st.text_input("Search remarks and submissions")
+    search_submissions = st.checkbox("Include submission text", value=True)
+    if search_query:
+        # Index-backed and limited, so search always reads the live database
+        results = search_records(search_query, include_submission_text=search_submissions)
+        if results:
+            column_names = ["ID", "Teacher", "Email", "Student", "Grade", "Marks", "Remarks", "Match"]
+            display_scrollable_dataframe(results, column_names)
+        else:
+            st.info("ℹ️ No matching records.")
+
+    # API calls saved by sharing identical in-flight requests (since this process started)
+    st.subheader("🔗 Request Coalescing")
+    coalescing_stats = get_coalescing_stats()
+    col1, col2 = st.columns(2)
+    for column, (name, stats) in zip((col1, col2), coalescing_stats.items()):
+        with column:
+            st.metric(f"{name} calls saved", stats["coalesced"],
+                      help=f"{stats['executed']} API calls made, {stats['in_flight']} in flight")
+
+    # Latency, cost and escalation rate of the cheap and large grading models
+    st.subheader("🧭 Model Routing")
+    routing_stats = get_routing_stats()
+    st.dataframe(pd.DataFrame.from_dict(routing_stats, orient="index"), use_container_width=True)
+
+    # Shared grading capacity: queue depth and wait time per teacher
+    st.subheader("⚖️ Grading Queue")
+    queue_stats = grading_scheduler.stats()
+    if queue_stats:
+        st.dataframe(pd.DataFrame.from_dict(queue_stats, orient="index"), use_container_width=True)
+    else:
+        st.info("ℹ️ No grading requests yet.")
+
+    # Regrade only records graded with an older prompt version or model
+    st.subheader("♻️ Regrade Stale Records")
+    # Only a COUNT runs on every rerun; the plan (reading and hashing every stale text) is built on click
+    stale_count, stale_without_text = count_stale_records(GRADING_PROMPT_VERSION, current_routing_versions())
+    models = f"{ROUTER_CHEAP_MODEL} → {GRADING_MODEL}" if ROUTER_ENABLED else GRADING_MODEL
+    st.write(f"Current prompt version: `{GRADING_PROMPT_VERSION}` ({models})")
+    st.write(f"{stale_count} stale records can be regraded")
+    if stale_without_text:
+        # Records saved before submission text was stored cannot be regraded without the original PDF
+        st.caption(f"{stale_without_text} older stale records have no stored submission text and cannot be regraded.")
+    if stale_count and st.button("♻️ Regrade Stale Records"):
+        with st.spinner("Regrading..."):
+            plan = plan_regrade()
+            report = run_regrade(plan)
+        records_changed = True
+        changed = [row for row in report if row["grade_changed"]]
+        failed = [row for row in report if row["error"]]
+        st.success(f"✅ Regraded {len(report) - len(failed)} records ({len(plan['jobs'])} distinct submissions), "
+                   f"{len(changed)} grades changed.")
+        if failed:
+            st.error(f"❌ {len(failed)} records could not be regraded and are still stale (IDs: "
+                     f"{', '.join(str(row['id']) for row in failed)}). First error: {failed[0]['error']}")
+        if plan["missing_text"]:
+            st.warning(f"⚠️ {len(plan['missing_text'])} stale records have no stored text and were skipped.")
+        st.dataframe(pd.DataFrame(report), use_container_width=True)
+
     # Display all records in the database
     st.subheader("📋 All Records")
-    records = get_all_records()
+    if use_snapshot and records_changed:
+        st.caption("Showing the live database because records were just changed.")
+    records = get_all_records(use_snapshot=use_snapshot and not records_changed)
     if records:
         column_names = ["ID", "Teacher", "Email", "Student", "Grade", "Marks", "Remarks"]
         display_scrollable_dataframe(records, column_names)
@@ -234,22 +381,39 @@ else:
                 st.warning("⚠️ Please enter all required fields (teacher name, email, student name).")
             elif not valid_email:
                 st.warning("⚠️ Please enter a valid email ending with @gmail.com or @bu.edu")
+            elif uploaded_file.size > PDF_MAX_BYTES:
+                st.error(f"❌ The PDF is too large (limit {PDF_MAX_BYTES // (1024 * 1024)} MB).")
             else:
-                # Save uploaded file to temporary location
+                # Save uploaded file to temporary location in chunks (no extra copy in memory)
                 with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                    tmp_file.write(uploaded_file.read())
+                    shutil.copyfileobj(uploaded_file, tmp_file, 1024 * 1024)
                     file_path = tmp_file.name
 
-                # Extract text from PDF and grade it
-                text = extract_text_from_pdf(file_path)
-                grade, marks, remarks = grade_assignment(text)
+                # Extract text in a sandboxed worker with size, page, time and memory limits
+                try:
+                    text, truncated = extract_text_guarded(file_path)
+                except PDFExtractionError as error:
+                    st.error(f"❌ {error}")
+                    st.stop()
+                finally:
+                    os.unlink(file_path)
+
+                if not text.strip():
+                    st.error("❌ No text could be extracted from this PDF (is it a scanned image?).")
+                    st.stop()
+                if truncated:
+                    st.warning("⚠️ The document is very long; only the beginning was graded.")
+
+                # Grade the extracted text (queued fairly against other teachers' work)
+                grade, marks, remarks, grading = grade_assignment_routed(text, teacher=teacher_email)
 
                 # Display results
                 st.success(f"Grade: {grade} | Marks: {marks}")
                 st.info(f"Remarks: {remarks}")
 
                 # Save record to database
-                insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks)
+                insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks,
+                              submission_text=text, content_hash=content_hash(text), **grading)
                 st.success("✅ Record saved to database.")
                 
                 # Set flag to show records and reset form
@@ -266,7 +430,7 @@ else:
 
         # Generate material button
         if topic and st.button("Generate"):
-            material = generate_teaching_material(topic)
+            material = generate_teaching_material(topic, teacher=teacher_email or "anonymous")
             st.session_state["material"] = material
             material_generated = True
 
@@ -282,15 +446,18 @@ else:
                 elif not valid_email:
                     st.warning("⚠️ Please enter a valid email ending with @gmail.com or @bu.edu")
                 else:
-                    # Grade the generated material
-                    grade, marks, remarks = grade_assignment(st.session_state["material"])
+                    # Grade the generated material (queued fairly against other teachers' work)
+                    material = st.session_state["material"]
+                    grade, marks, remarks, grading = grade_assignment_routed(material, teacher=teacher_email)
                     
                     # Display results
                     st.success(f"Grade: {grade} | Marks: {marks}")
                     st.info(f"Remarks: {remarks}")
 
                     # Save record to database
-                    insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks)
+                    insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks,
+                                  submission_text=st.session_state["material"],
+                                  content_hash=content_hash(st.session_state["material"]), **grading)
                     st.success("✅ Record saved to database.")
                     
                     # Set flag to show records and reset form
@@ -315,12 +482,11 @@ else:
         st.rerun()
     
     # Only retrieve and display records if the display flag is set
-    conn = sqlite3.connect("students.db")
-    df = pd.read_sql_query("SELECT * FROM students", conn)
-    conn.close()
+    records = get_all_records()
 
     st.subheader("📋 All Student Submissions")
-    if not df.empty:
-        display_scrollable_dataframe(df.values.tolist(), df.columns.tolist())
+    if records:
+        column_names = ["ID", "Teacher", "Email", "Student", "Grade", "Marks", "Remarks"]
+        display_scrollable_dataframe(records, column_names)
     else:
         st.info("ℹ️ No records found.")
@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import time
+import uuid
+
+from database import (
+    create_students_table, create_grading_batch, set_grading_batch_submitted, set_grading_batch_status,
+    get_grading_batch, get_pending_grading_batches, get_unfinished_grading_batches,
+    insert_batch_results, fail_pending_batch_items, get_failed_batch_items
+)
+from openai_utils import (
+    GRADING_MAX_TOKENS, GRADING_MODEL, GRADING_PROMPT_VERSION,
+    build_grading_messages, content_hash, parse_grading_response, routing_version
+)
+
+# Offline batch grading
+# For end-of-term bulk grading, the grading requests for many submissions are
+# written to one JSONL file and sent through the provider's batch interface,
+# which is cheaper than interactive calls. The batch is polled until it
+# finishes, then the results are parsed and inserted into students.db. Batch
+# and item state lives in the database, so collecting can be resumed after a
+# crash without creating duplicate records:
+# - a batch is saved as pending (items and input file) before it is sent, and
+#   gets its provider ID once the provider accepts it;
+# - items without a result in a finished batch are marked failed and sent
+#   again in a new batch, up to BATCH_MAX_ATTEMPTS times in total.
+
+# Provider statuses after which a batch will not change any more
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Directory where batch input files are written
+BATCH_WORK_DIR = os.getenv("BATCH_WORK_DIR", "batches")
+# How many batches one submission is sent in before it is given up on
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+
+
+class OpenAIBatchAdapter:
+    """
+    Batch interface of the OpenAI API
+
+    Args:
+        client: OpenAI client (defaults to the one configured in openai_utils)
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            from openai_utils import client
+        self.client = client
+
+    def submit(self, input_path):
+        # Upload the JSONL file, then start a batch over it
+        with open(input_path, "rb") as input_file:
+            uploaded = self.client.files.create(file=input_file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        # Successful requests are in the output file, failed ones in the error file
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(self.client.files.content(file_id).text.splitlines())
+        return lines
+
+
+class LocalBatchAdapter:
+    """
+    File-based stand-in for a batch provider (tests and offline runs)
+
+    Each submitted file is answered immediately by calling responder with the
+    request body; the output is written next to the input in the provider's
+    result format.
+
+    Args:
+        directory (str): Where inputs and outputs are kept
+        responder (callable): Called with a request body, returns the reply text
+    """
+
+    def __init__(self, directory, responder):
+        self.directory = directory
+        self.responder = responder
+        os.makedirs(directory, exist_ok=True)
+
+    def _output_path(self, batch_id):
+        return os.path.join(self.directory, f"{batch_id}.output.jsonl")
+
+    def submit(self, input_path):
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        with open(input_path) as input_file, open(self._output_path(batch_id), "w") as output_file:
+            for line in input_file:
+                request = json.loads(line)
+                content = self.responder(request["body"])
+                output_file.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}
+                    },
+                    "error": None
+                }) + "\n")
+        return batch_id
+
+    def status(self, batch_id):
+        return "completed" if os.path.exists(self._output_path(batch_id)) else "failed"
+
+    def results(self, batch_id):
+        if not os.path.exists(self._output_path(batch_id)):
+            return []
+        with open(self._output_path(batch_id)) as output_file:
+            return output_file.read().splitlines()
+
+
+def write_batch_file(items, path, model=GRADING_MODEL):
+    """
+    Write the grading requests for many submissions as a batch JSONL file
+
+    Args:
+        items (list): Dicts with custom_id and submission_text
+        path (str): Output file path
+        model (str): Model named in every request
+    """
+    with open(path, "w") as batch_file:
+        for item in items:
+            batch_file.write(json.dumps({
+                "custom_id": item["custom_id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": build_grading_messages(item["submission_text"]),
+                    "max_tokens": GRADING_MAX_TOKENS
+                }
+            }) + "\n")
+
+
+def _create_batch(items, work_dir, replaces=None):
+    # Write the input file and save the batch as pending, before anything is sent
+    os.makedirs(work_dir, exist_ok=True)
+    batch_id = f"grading-{uuid.uuid4().hex[:12]}"
+    input_path = os.path.join(work_dir, f"{batch_id}.input.jsonl")
+    write_batch_file(items, input_path)
+    # Batches always use the large model, without the cheap-first routing
+    create_grading_batch(batch_id, items, GRADING_PROMPT_VERSION, GRADING_MODEL, routing_version("large"),
+                         input_path, replaces)
+    return batch_id, input_path
+
+
+def send_grading_batch(batch_id, input_path, adapter):
+    """
+    Send a saved (pending) batch to the provider and record the provider's ID
+
+    If the process stops after the provider accepted the file but before the
+    ID was recorded, the batch is still pending and is sent again on resume;
+    its items are stored once, whichever copy is collected first.
+
+    Args:
+        batch_id (str): Local batch ID
+        input_path (str): The batch's JSONL input file
+        adapter: Batch provider adapter
+
+    Returns:
+        str: The provider's batch ID
+    """
+    provider_batch_id = adapter.submit(input_path)
+    set_grading_batch_submitted(batch_id, provider_batch_id)
+    return provider_batch_id
+
+
+def submit_grading_batch(submissions, adapter, work_dir=BATCH_WORK_DIR):
+    """
+    Render, save and submit a grading batch
+
+    Args:
+        submissions (list): Dicts with teacher_name, teacher_email, student_name and text
+        adapter: Batch provider adapter (OpenAIBatchAdapter or LocalBatchAdapter)
+        work_dir (str): Directory for the batch input file
+
+    Returns:
+        str: The local batch ID, used to poll and collect the batch
+    """
+    items = [{
+        "custom_id": f"item-{index}",
+        "teacher_name": submission["teacher_name"],
+        "teacher_email": submission["teacher_email"],
+        "student_name": submission["student_name"],
+        "submission_text": submission["text"],
+        "content_hash": content_hash(submission["text"]),
+    } for index, submission in enumerate(submissions)]
+
+    batch_id, input_path = _create_batch(items, work_dir)
+    send_grading_batch(batch_id, input_path, adapter)
+    return batch_id
+
+
+def wait_for_batch(batch_id, adapter, poll_seconds=60, timeout_seconds=None):
+    """
+    Poll a batch until it reaches a terminal status
+
+    Args:
+        batch_id (str): Local ID of the batch to poll
+        adapter: Batch provider adapter
+        poll_seconds (float): Delay between polls
+        timeout_seconds (float): Give up after this long (None waits forever)
+
+    Returns:
+        str: Last status seen (not terminal if the timeout was hit)
+    """
+    provider_batch_id = get_grading_batch(batch_id)[1]
+    deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+    while True:
+        status = adapter.status(provider_batch_id)
+        set_grading_batch_status(batch_id, status)
+        if status in TERMINAL_STATUSES:
+            return status
+        if deadline is not None and time.monotonic() >= deadline:
+            return status
+        time.sleep(poll_seconds)
+
+
+def parse_batch_results(lines):
+    """
+    Parse provider result lines into grades
+
+    Args:
+        lines (list): JSONL result lines
+
+    Returns:
+        tuple: (results, failed) where results is a list of
+               (custom_id, grade, marks, remarks) and failed lists custom_ids
+    """
+    results = []
+    failed = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get("response") or {}
+        if entry.get("error") or response.get("status_code") != 200:
+            failed.append(entry["custom_id"])
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        results.append((entry["custom_id"], *parse_grading_response(content)))
+    return results, failed
+
+
+def collect_grading_batch(batch_id, adapter):
+    """
+    Store the results of a finished batch in students.db
+
+    Items without a successful result are marked failed, so they can be sent
+    again by retry_failed_items. Safe to call again for the same batch:
+    items already stored are skipped.
+
+    Args:
+        batch_id (str): Local ID of the batch to collect
+        adapter: Batch provider adapter
+
+    Returns:
+        dict: inserted (new records), failed (custom_ids without a result)
+    """
+    provider_batch_id = get_grading_batch(batch_id)[1]
+    results, _ = parse_batch_results(adapter.results(provider_batch_id))
+    inserted = insert_batch_results(batch_id, results)
+    return {"inserted": inserted, "failed": fail_pending_batch_items(batch_id)}
+
+
+def retry_failed_items(adapter, max_attempts=BATCH_MAX_ATTEMPTS, work_dir=BATCH_WORK_DIR):
+    """
+    Send failed items again in one new batch
+
+    Items that have already been sent max_attempts times stay failed.
+
+    Args:
+        adapter: Batch provider adapter
+        max_attempts (int): Batches a submission may be sent in, in total
+        work_dir (str): Directory for the batch input file
+
+    Returns:
+        tuple: (new batch ID or None, list of (batch_id, custom_id) given up on)
+    """
+    retryable, exhausted = get_failed_batch_items(max_attempts)
+    exhausted = [(row[0], row[1]) for row in exhausted]
+    if not retryable:
+        return None, exhausted
+
+    items = [{
+        "custom_id": f"item-{index}",
+        "teacher_name": teacher_name,
+        "teacher_email": teacher_email,
+        "student_name": student_name,
+        "submission_text": submission_text,
+        "content_hash": item_hash,
+        "attempt": attempt + 1,
+    } for index, (_, _, teacher_name, teacher_email, student_name, submission_text, item_hash, attempt)
+        in enumerate(retryable)]
+
+    # The old items are marked as retried in the same transaction that saves the new batch
+    batch_id, input_path = _create_batch(items, work_dir, replaces=[(row[0], row[1]) for row in retryable])
+    send_grading_batch(batch_id, input_path, adapter)
+    return batch_id, exhausted
+
+
+def resume_grading_batches(adapter, poll_seconds=60, timeout_seconds=None,
+                           max_attempts=BATCH_MAX_ATTEMPTS, work_dir=BATCH_WORK_DIR):
+    """
+    Finish every batch that is not fully stored
+
+    Sends batches that were saved but never submitted, polls and collects
+    submitted ones, then sends failed items again in a new batch.
+
+    Returns:
+        dict: batches (collect summary per finished batch; batches still
+              running are left for later), retry_batch_id (new batch with the
+              failed items, or None) and exhausted (items given up on)
+    """
+    for batch_id, input_path in get_pending_grading_batches():
+        send_grading_batch(batch_id, input_path, adapter)
+
+    summary = {}
+    for batch_id, _, _, _, _ in get_unfinished_grading_batches():
+        status = wait_for_batch(batch_id, adapter, poll_seconds, timeout_seconds)
+        # Expired or cancelled batches can still hold results for some items
+        if status in TERMINAL_STATUSES:
+            summary[batch_id] = collect_grading_batch(batch_id, adapter)
+
+    retry_batch_id, exhausted = retry_failed_items(adapter, max_attempts, work_dir)
+    return {"batches": summary, "retry_batch_id": retry_batch_id, "exhausted": exhausted}
+
+
+def main():
+    # Command line entry point: submit a folder of PDFs, or resume pending batches
+    parser = argparse.ArgumentParser(description="Offline batch grading")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="Grade PDFs in one batch (student name = file name)")
+    submit.add_argument("--teacher-name", required=True)
+    submit.add_argument("--teacher-email", required=True)
+    submit.add_argument("pdfs", nargs="+")
+
+    commands.add_parser("resume", help="Poll and collect all unfinished batches")
+    args = parser.parse_args()
+
+    create_students_table()
+    adapter = OpenAIBatchAdapter()
+
+    if args.command == "submit":
+        from pdf_guard import extract_text_guarded, PDFExtractionError
+        submissions = []
+        for path in args.pdfs:
+            try:
+                text, _ = extract_text_guarded(path)
+            except PDFExtractionError as error:
+                print(f"Skipping {path}: {error}")
+                continue
+            submissions.append({
+                "teacher_name": args.teacher_name,
+                "teacher_email": args.teacher_email,
+                "student_name": os.path.splitext(os.path.basename(path))[0],
+                "text": text,
+            })
+        batch_id = submit_grading_batch(submissions, adapter)
+        print(f"Submitted batch {batch_id} with {len(submissions)} submissions")
+    else:
+        summary = resume_grading_batches(adapter)
+        for batch_id, result in summary["batches"].items():
+            print(f"{batch_id}: inserted {result['inserted']}, failed {len(result['failed'])}")
+        if summary["retry_batch_id"]:
+            print(f"Resubmitted failed items as batch {summary['retry_batch_id']}")
+        for batch_id, custom_id in summary["exhausted"]:
+            print(f"Gave up on {batch_id}/{custom_id} after {BATCH_MAX_ATTEMPTS} attempts")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,63 @@
+import os
+import socket
 import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from storage import create_backend
+
+# Path of the SQLite database file
+# Point every replica at the same file (on a shared volume) to share results
+DB_PATH = os.getenv("STUDENTS_DB_PATH", "students.db")
+# Storage backend name (see storage.py): "sqlite-wal" for multi-process writers, "sqlite" for the plain file
+DB_BACKEND = os.getenv("STUDENTS_DB_BACKEND", "sqlite-wal")
+
+# Columns shown for a record everywhere in the app (ID, Teacher, Email, Student, Grade, Marks, Remarks)
+RECORD_COLUMNS = "id, teacher_name, teacher_email, student_name, grade, marks, remarks"
+
+# Bulk deletes run in chunks of this many rows, one short transaction per chunk
+DELETE_CHUNK_SIZE = 500
+# Pause between chunks so grading writes waiting on the lock can get in
+CHUNK_PAUSE_SECONDS = 0.01
+
+# Online backups: directory, how many are kept, pages copied per step and pause between steps
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_PAUSE_SECONDS = float(os.getenv("BACKUP_PAUSE_SECONDS", "0.01"))
+# Read-only copy used by heavy admin reads (defaults to "<DB_PATH>.snapshot")
+SNAPSHOT_PATH = os.getenv("STUDENTS_SNAPSHOT_PATH")
+
+# Backend instances by (name, path), so every caller in a process shares one write queue
+_backends = {}
+_backends_lock = threading.Lock()
+
+# Function to get the SQLite connection backend for the configured database file
+# Returns the same backend object for every call with the same settings
+def get_backend():
+    key = (DB_BACKEND, DB_PATH)
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = create_backend(DB_BACKEND, DB_PATH)
+        return _backends[key]
 
 # Function to create a database connection
 # Returns a connection object to the SQLite database
 def connect_db():
-    return sqlite3.connect("students.db")
+    return get_backend().connect()
+
+# Function to add a column to an existing table if it is missing
+# Lets databases created by older versions pick up new columns
+# Returns True if the column was added
+def _ensure_column(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = [row[1] for row in cursor.fetchall()]
+    if column not in existing:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    return False
 
 # Function to initialize the database structure
 # Creates the students table if it doesn't already exist
@@ -12,6 +66,10 @@ def create_students_table():
     conn = connect_db()
     cursor = conn.cursor()
     
+    # Let deleted pages be returned to the OS a few at a time instead of by a full VACUUM
+    # (only takes effect on a new database; an existing one is switched by enable_incremental_vacuum)
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    
     # SQL to create table with defined columns if it doesn't exist
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS students (
@@ -21,93 +79,802 @@ def create_students_table():
             student_name TEXT,                     -- Name of the student
             grade TEXT,                            -- Letter grade (A-F)
             marks INTEGER,                         -- Numeric score (0-100)
-            remarks TEXT                           -- Feedback comments
+            remarks TEXT,                          -- Feedback comments
+            submission_text TEXT,                  -- Extracted submission text (optional, for search)
+            deleted_at TEXT,                       -- Soft delete timestamp (NULL while the record is live)
+            prompt_version TEXT,                   -- Version of the grading prompt used
+            model TEXT,                            -- Model that produced the grade
+            content_hash TEXT,                     -- SHA-256 of the graded text
+            routing_version TEXT                   -- Version of the model routing settings that accepted the grade
+        )
+    ''')
+    _ensure_column(cursor, "students", "submission_text", "TEXT")
+    _ensure_column(cursor, "students", "deleted_at", "TEXT")
+    _ensure_column(cursor, "students", "prompt_version", "TEXT")
+    _ensure_column(cursor, "students", "model", "TEXT")
+    _ensure_column(cursor, "students", "content_hash", "TEXT")
+    _ensure_column(cursor, "students", "routing_version", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_deleted_at ON students(deleted_at)")
+    # Staleness is decided by prompt and routing version (the model column is informational)
+    cursor.execute("DROP INDEX IF EXISTS idx_students_grading_version")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_students_grading_routing ON students(prompt_version, routing_version)
+    ''')
+
+    # Full-text index over remarks and submission text
+    # External-content FTS5 table: the text lives in students, the index in students_fts
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'students_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+            remarks, submission_text,
+            content='students', content_rowid='id'
         )
     ''')
+
+    # Triggers keep the index in sync with every insert, update and delete on students
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON students BEGIN
+            INSERT INTO students_fts(rowid, remarks, submission_text)
+            VALUES (new.id, new.remarks, new.submission_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON students BEGIN
+            INSERT INTO students_fts(students_fts, rowid, remarks, submission_text)
+            VALUES ('delete', old.id, old.remarks, old.submission_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS students_fts_update AFTER UPDATE OF remarks, submission_text ON students BEGIN
+            INSERT INTO students_fts(students_fts, rowid, remarks, submission_text)
+            VALUES ('delete', old.id, old.remarks, old.submission_text);
+            INSERT INTO students_fts(rowid, remarks, submission_text)
+            VALUES (new.id, new.remarks, new.submission_text);
+        END
+    ''')
+
+    # Index rows that existed before the search table was created
+    if not fts_exists:
+        cursor.execute("INSERT INTO students_fts(students_fts) VALUES ('rebuild')")
+
+    # Leases let one replica claim a background job so it is not run by every process
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,                 -- Job name
+            owner TEXT,                            -- Process holding the lease (host:pid)
+            expires_at REAL                        -- Unix time when the lease can be taken over
+        )
+    ''')
+
+    # State of offline batch grading jobs, so an interrupted submit or collect can be resumed
+    # A batch is saved as 'pending' before it is sent, and gets its provider ID once accepted
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS grading_batches (
+            batch_id TEXT PRIMARY KEY,             -- Local batch ID
+            status TEXT,                           -- 'pending' until submitted, then the last known provider status
+            prompt_version TEXT,                   -- Grading prompt version used in the batch
+            model TEXT,                            -- Model used in the batch
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            routing_version TEXT,                  -- Routing version stored with the batch's records
+            provider_batch_id TEXT,                -- ID returned by the batch provider (NULL while pending)
+            input_path TEXT                        -- JSONL input file sent to the provider
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS grading_batch_items (
+            batch_id TEXT,                         -- Batch the item belongs to
+            custom_id TEXT,                        -- Request ID inside the batch file
+            teacher_name TEXT,
+            teacher_email TEXT,
+            student_name TEXT,
+            submission_text TEXT,
+            content_hash TEXT,
+            record_id INTEGER,                     -- Students row once the result is inserted
+            state TEXT DEFAULT 'pending',          -- pending, done, failed or retried (moved to a newer batch)
+            attempt INTEGER DEFAULT 1,             -- How many batches this submission has been sent in
+            PRIMARY KEY (batch_id, custom_id)
+        )
+    ''')
+    # Batches saved before the provider ID had its own column were keyed by the provider ID
+    if _ensure_column(cursor, "grading_batches", "provider_batch_id", "TEXT"):
+        cursor.execute("UPDATE grading_batches SET provider_batch_id = batch_id")
+    _ensure_column(cursor, "grading_batches", "input_path", "TEXT")
+    _ensure_column(cursor, "grading_batches", "routing_version", "TEXT")
+    if _ensure_column(cursor, "grading_batch_items", "state", "TEXT DEFAULT 'pending'"):
+        cursor.execute("UPDATE grading_batch_items SET state = 'done' WHERE record_id IS NOT NULL")
+    _ensure_column(cursor, "grading_batch_items", "attempt", "INTEGER DEFAULT 1")
     
-    # Commit changes and close connection
+    # Commit changes, apply backend settings (e.g. WAL) and close connection
     conn.commit()
+    get_backend().configure(conn)
     conn.close()
 
 # Function to add a new record to the database
 # Inserts student assignment data with grade information
-def insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks):
+# Optionally stores the extracted submission text so it can be searched later,
+# and the prompt version, model, routing version and content hash so stale grades can be found
+# Returns the ID of the new record
+def insert_record(teacher_name, teacher_email, student_name, grade, marks, remarks, submission_text=None,
+                  prompt_version=None, model=None, content_hash=None, routing_version=None):
     # Debug prints to console
     print(">>> Inserting into DB")
     print("Teacher:", teacher_name)
     print("Student:", student_name)
     print("Grade:", grade, "Marks:", marks)
     
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to insert new record with provided values
+        # Using parameterized query to prevent SQL injection
+        cursor.execute('''
+            INSERT INTO students (teacher_name, teacher_email, student_name, grade, marks, remarks, submission_text,
+                                  prompt_version, model, content_hash, routing_version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (teacher_name, teacher_email, student_name, grade, marks, remarks, submission_text,
+              prompt_version, model, content_hash, routing_version))
+        record_id = cursor.lastrowid
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+    return record_id
+
+# Function to replace the grade of an existing record after regrading
+# Also records which prompt version, model and routing version produced the new grade
+def update_grade(record_id, grade, marks, remarks, prompt_version, model, content_hash, routing_version=None):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to overwrite the grading columns of one record
+        cursor.execute('''
+            UPDATE students
+            SET grade = ?, marks = ?, remarks = ?, prompt_version = ?, model = ?, content_hash = ?,
+                routing_version = ?
+            WHERE id = ?
+        ''', (grade, marks, remarks, prompt_version, model, content_hash, routing_version, record_id))
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+
+# Function to build the condition selecting live records that need regrading
+# A record is stale when its prompt version differs, or its routing version is not one of the
+# versions the current settings produce (NULL means graded before versioning)
+def _stale_condition(prompt_version, routing_versions):
+    routing_versions = list(routing_versions)
+    placeholders = ", ".join("?" for _ in routing_versions)
+    condition = f'''
+        deleted_at IS NULL
+        AND (prompt_version IS NOT ? OR routing_version IS NULL OR routing_version NOT IN ({placeholders}))
+    '''
+    return condition, [prompt_version, *routing_versions]
+
+# Function to find live records graded with a different prompt version or routing settings
+# Returns rows of (id, teacher_email, student_name, grade, marks, remarks, submission_text, content_hash)
+def get_stale_records(prompt_version, routing_versions):
+    condition, params = _stale_condition(prompt_version, routing_versions)
+    
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to select records whose grading version does not match
+    cursor.execute(f'''
+        SELECT id, teacher_email, student_name, grade, marks, remarks, submission_text, content_hash
+        FROM students
+        WHERE {condition}
+        ORDER BY id
+    ''', params)
+    rows = cursor.fetchall()
+    
+    # Close connection and return data
+    conn.close()
+    return rows
+
+# Function to count live records graded with a different prompt version or routing settings
+# Cheap enough to show on every page load (submission text is only checked for presence)
+# Returns (with_text, without_text): records that can be regraded from their stored text,
+# and records created before the text was stored, which need a text_loader to be regraded
+def count_stale_records(prompt_version, routing_versions):
+    condition, params = _stale_condition(prompt_version, routing_versions)
+    
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to count the same records get_stale_records would return, split by stored text
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(submission_text IS NOT NULL AND submission_text != ''), 0),
+               COALESCE(SUM(submission_text IS NULL OR submission_text = ''), 0)
+        FROM students WHERE {condition}
+    ''', params)
+    with_text, without_text = cursor.fetchone()
+    
+    # Close connection and return the counts
+    conn.close()
+    return with_text, without_text
+
+# Function to save a grading batch and its items before it is sent to the provider
+# items are dicts with custom_id, teacher_name, teacher_email, student_name, submission_text,
+# content_hash and optionally attempt; replaces lists (batch_id, custom_id) of failed items
+# that this batch retries, which are marked 'retried' in the same transaction
+def create_grading_batch(batch_id, items, prompt_version, model, routing_version=None, input_path=None,
+                         replaces=None):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to store the batch and all of its items in one transaction
+        cursor.execute('''
+            INSERT INTO grading_batches (batch_id, status, prompt_version, model, routing_version, input_path)
+            VALUES (?, 'pending', ?, ?, ?, ?)
+        ''', (batch_id, prompt_version, model, routing_version, input_path))
+        cursor.executemany('''
+            INSERT INTO grading_batch_items
+                (batch_id, custom_id, teacher_name, teacher_email, student_name, submission_text, content_hash,
+                 attempt)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(batch_id, item["custom_id"], item["teacher_name"], item["teacher_email"],
+               item["student_name"], item["submission_text"], item["content_hash"], item.get("attempt", 1))
+              for item in items])
+        cursor.executemany('''
+            UPDATE grading_batch_items SET state = 'retried' WHERE batch_id = ? AND custom_id = ? AND state = 'failed'
+        ''', replaces or [])
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+
+# Function to record the provider's ID once a pending batch has been accepted
+def set_grading_batch_submitted(batch_id, provider_batch_id):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to store the provider ID and leave the pending state
+        cursor.execute('''
+            UPDATE grading_batches SET provider_batch_id = ?, status = 'submitted' WHERE batch_id = ?
+        ''', (provider_batch_id, batch_id))
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+
+# Function to record the latest provider status of a grading batch
+def set_grading_batch_status(batch_id, status):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to update the stored status
+        cursor.execute("UPDATE grading_batches SET status = ? WHERE batch_id = ?", (status, batch_id))
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+
+# Function to look up one grading batch
+# Returns (batch_id, provider_batch_id, status, input_path) or None
+def get_grading_batch(batch_id):
     # Establish database connection
     conn = connect_db()
     cursor = conn.cursor()
     
-    # SQL to insert new record with provided values
-    # Using parameterized query to prevent SQL injection
+    # SQL to select the batch by its local ID
     cursor.execute('''
-        INSERT INTO students (teacher_name, teacher_email, student_name, grade, marks, remarks)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (teacher_name, teacher_email, student_name, grade, marks, remarks))
+        SELECT batch_id, provider_batch_id, status, input_path FROM grading_batches WHERE batch_id = ?
+    ''', (batch_id,))
+    row = cursor.fetchone()
     
-    # Commit changes and close connection
-    conn.commit()
+    # Close connection and return data
     conn.close()
+    return row
 
-# Function to delete the most recently added record
-# Removes the record with the highest ID from the database
-def delete_latest_record():
+# Function to list grading batches that were saved but never accepted by the provider
+# (e.g. the process stopped between saving and submitting)
+# Returns rows of (batch_id, input_path)
+def get_pending_grading_batches():
     # Establish database connection
     conn = connect_db()
     cursor = conn.cursor()
     
-    # SQL to delete the record with the maximum ID value
+    # SQL to select batches without a provider ID
     cursor.execute('''
-        DELETE FROM students
-        WHERE id = (SELECT MAX(id) FROM students)
+        SELECT batch_id, input_path FROM grading_batches
+        WHERE provider_batch_id IS NULL
+        ORDER BY created_at, batch_id
     ''')
+    rows = cursor.fetchall()
     
-    # Commit changes and close connection
-    conn.commit()
+    # Close connection and return data
     conn.close()
+    return rows
 
-# Function to delete a specific record by its ID
-# Removes a single record identified by the provided ID
-def delete_record_by_id(record_id):
+# Function to list submitted grading batches whose items are not all finished yet
+# Returns rows of (batch_id, provider_batch_id, status, prompt_version, model)
+def get_unfinished_grading_batches():
     # Establish database connection
     conn = connect_db()
     cursor = conn.cursor()
     
-    # SQL to delete record with matching ID
-    # Using parameterized query for security
-    cursor.execute('DELETE FROM students WHERE id = ?', (record_id,))
+    # SQL to select submitted batches that still have pending items
+    cursor.execute('''
+        SELECT b.batch_id, b.provider_batch_id, b.status, b.prompt_version, b.model
+        FROM grading_batches b
+        WHERE b.provider_batch_id IS NOT NULL
+          AND EXISTS (SELECT 1 FROM grading_batch_items i WHERE i.batch_id = b.batch_id AND i.state = 'pending')
+        ORDER BY b.created_at, b.batch_id
+    ''')
+    rows = cursor.fetchall()
     
-    # Commit changes and close connection
-    conn.commit()
+    # Close connection and return data
+    conn.close()
+    return rows
+
+# Function to mark the items of a finished batch that got no result as failed
+# Returns the custom_ids of the items marked
+def fail_pending_batch_items(batch_id):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to find and mark the items still waiting, in one transaction
+        cursor.execute('''
+            SELECT custom_id FROM grading_batch_items WHERE batch_id = ? AND state = 'pending' ORDER BY rowid
+        ''', (batch_id,))
+        custom_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+            UPDATE grading_batch_items SET state = 'failed' WHERE batch_id = ? AND state = 'pending'
+        ''', (batch_id,))
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+    return custom_ids
+
+# Function to list failed batch items, split by whether they may be sent again
+# Returns (retryable, exhausted): rows of (batch_id, custom_id, teacher_name, teacher_email,
+# student_name, submission_text, content_hash, attempt)
+def get_failed_batch_items(max_attempts):
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to select failed items that have not been moved to a newer batch
+    cursor.execute('''
+        SELECT batch_id, custom_id, teacher_name, teacher_email, student_name, submission_text, content_hash,
+               attempt
+        FROM grading_batch_items
+        WHERE state = 'failed'
+        ORDER BY batch_id, rowid
+    ''')
+    rows = cursor.fetchall()
+    
+    # Close connection and return data
     conn.close()
+    return [row for row in rows if row[7] < max_attempts], [row for row in rows if row[7] >= max_attempts]
+
+# Function to store the results of a grading batch as student records
+# results is a list of (custom_id, grade, marks, remarks); items already stored are skipped,
+# so collecting the same batch again never creates duplicates
+# Returns the number of records inserted
+def insert_batch_results(batch_id, results, chunk_size=None):
+    chunk_size = chunk_size or DELETE_CHUNK_SIZE
+    inserted = 0
+    
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    for start in range(0, len(results), chunk_size):
+        # Each chunk inserts the records and marks their items as done in one transaction
+        with get_backend().write_turn():
+            for custom_id, grade, marks, remarks in results[start:start + chunk_size]:
+                cursor.execute('''
+                    INSERT INTO students (teacher_name, teacher_email, student_name, grade, marks, remarks,
+                                          submission_text, prompt_version, model, content_hash, routing_version)
+                    SELECT i.teacher_name, i.teacher_email, i.student_name, ?, ?, ?,
+                           i.submission_text, b.prompt_version, b.model, i.content_hash, b.routing_version
+                    FROM grading_batch_items i JOIN grading_batches b ON b.batch_id = i.batch_id
+                    WHERE i.batch_id = ? AND i.custom_id = ? AND i.state = 'pending'
+                ''', (grade, marks, remarks, batch_id, custom_id))
+                if cursor.rowcount == 1:
+                    cursor.execute('''
+                        UPDATE grading_batch_items SET record_id = ?, state = 'done'
+                        WHERE batch_id = ? AND custom_id = ?
+                    ''', (cursor.lastrowid, batch_id, custom_id))
+                    inserted += 1
+            conn.commit()
+    
+    # Close connection and return number of records inserted
+    conn.close()
+    return inserted
+
+# Function to soft delete the most recently added record
+# Marks the live record with the highest ID as deleted
+def delete_latest_record():
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # SQL to mark the record with the maximum ID value as deleted
+        cursor.execute('''
+            UPDATE students SET deleted_at = CURRENT_TIMESTAMP
+            WHERE id = (SELECT MAX(id) FROM students WHERE deleted_at IS NULL)
+        ''')
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+
+# Function to soft delete a specific record by its ID
+# Marks a single record identified by the provided ID as deleted
+def delete_record_by_id(record_id):
+    soft_delete_records([record_id])
 
 # Function to clear all records from the table
-# Removes all data while keeping the table structure
+# Soft deletes every live record in chunks; the purge job removes them for good
 def clear_students_table():
+    return soft_delete_records(find_record_ids())
+
+# Function to run one statement over a list of IDs in chunked transactions
+# Each chunk is committed on its own so no single transaction holds the write lock for long
+# The statement must contain a single {ids} placeholder for the IN (...) list;
+# params are bound before the IDs, so conditions written ahead of IN (...) are re-checked per chunk
+def _execute_in_chunks(sql, record_ids, chunk_size=None, params=()):
+    chunk_size = chunk_size or DELETE_CHUNK_SIZE
+    record_ids = list(record_ids)
+    affected = 0
+    
     # Establish database connection
     conn = connect_db()
     cursor = conn.cursor()
     
-    # SQL to delete all records from the table
-    cursor.execute('DELETE FROM students')
+    for start in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[start:start + chunk_size]
+        placeholders = ", ".join("?" for _ in chunk)
+        
+        # Queue for every chunk separately so grading inserts get in between chunks
+        with get_backend().write_turn():
+            cursor.execute(sql.format(ids=placeholders), [*params, *chunk])
+            affected += cursor.rowcount
+            conn.commit()
+        
+        # Give writers in other processes a chance to take the lock
+        if start + chunk_size < len(record_ids):
+            time.sleep(CHUNK_PAUSE_SECONDS)
     
-    # Commit changes and close connection
-    conn.commit()
+    # Close connection and return number of rows changed
     conn.close()
+    return affected
+
+# Function to soft delete several records at once
+# Returns the number of records marked as deleted
+def soft_delete_records(record_ids, chunk_size=None):
+    return _execute_in_chunks(
+        "UPDATE students SET deleted_at = CURRENT_TIMESTAMP WHERE deleted_at IS NULL AND id IN ({ids})",
+        record_ids, chunk_size
+    )
+
+# Function to undo a soft delete for several records
+# Returns the number of records restored
+def restore_records(record_ids, chunk_size=None):
+    return _execute_in_chunks(
+        "UPDATE students SET deleted_at = NULL WHERE deleted_at IS NOT NULL AND id IN ({ids})",
+        record_ids, chunk_size
+    )
+
+# Function to permanently delete several records at once
+# Returns the number of records removed
+def hard_delete_records(record_ids, chunk_size=None):
+    return _execute_in_chunks("DELETE FROM students WHERE id IN ({ids})", record_ids, chunk_size)
+
+# Function to build the WHERE conditions for the record filters
+# Returns (conditions, params); filters that are None are ignored
+def _record_filter(teacher_email=None, student_name=None, grade=None, include_deleted=False):
+    conditions = []
+    params = []
+    if teacher_email:
+        conditions.append("teacher_email = ?")
+        params.append(teacher_email)
+    if student_name:
+        conditions.append("student_name = ?")
+        params.append(student_name)
+    if grade:
+        conditions.append("grade = ?")
+        params.append(grade)
+    if not include_deleted:
+        conditions.append("deleted_at IS NULL")
+    return conditions, params
+
+# Function to find the IDs of records matching optional filters
+# Filters that are None are ignored; with no filters every live record matches
+def find_record_ids(teacher_email=None, student_name=None, grade=None, include_deleted=False):
+    conditions, params = _record_filter(teacher_email, student_name, grade, include_deleted)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to select the IDs of matching records
+    cursor.execute(f"SELECT id FROM students {where} ORDER BY id", params)
+    record_ids = [row[0] for row in cursor.fetchall()]
+    
+    # Close connection and return IDs
+    conn.close()
+    return record_ids
+
+# Function to delete every record matching the given filters
+# Soft deletes by default; pass soft=False to remove the rows permanently
+def delete_records_matching(teacher_email=None, student_name=None, grade=None, soft=True):
+    """
+    Bulk delete records selected by filter
+    
+    Args:
+        teacher_email (str): Only records from this teacher
+        student_name (str): Only records for this student
+        grade (str): Only records with this letter grade
+        soft (bool): Mark records as deleted instead of removing them
+        
+    Returns:
+        int: Number of records deleted
+    """
+    # Refuse to treat "no filters" as "everything"; clear_students_table is the explicit way
+    if not (teacher_email or student_name or grade):
+        raise ValueError("At least one filter is required for a bulk delete")
+    
+    record_ids = find_record_ids(teacher_email, student_name, grade, include_deleted=not soft)
+    if soft:
+        return soft_delete_records(record_ids)
+    
+    # Re-apply the filter in every chunk, so a row edited since the select is left alone
+    conditions, params = _record_filter(teacher_email, student_name, grade, include_deleted=True)
+    return _execute_in_chunks(
+        f"DELETE FROM students WHERE {' AND '.join(conditions)} AND id IN ({{ids}})",
+        record_ids, params=params
+    )
+
+# Function to permanently remove records that were soft deleted a while ago
+# Returns the number of records purged
+def purge_deleted_records(older_than_seconds=0, chunk_size=None):
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to select records whose soft delete is older than the retention period
+    retention = f"-{int(older_than_seconds)} seconds"
+    cursor.execute('''
+        SELECT id FROM students
+        WHERE deleted_at IS NOT NULL AND deleted_at <= datetime('now', ?)
+    ''', (retention,))
+    record_ids = [row[0] for row in cursor.fetchall()]
+    
+    # Close connection before the chunked delete opens its own
+    conn.close()
+    
+    # Each chunk checks the delete again, so a record restored since the select is kept
+    return _execute_in_chunks('''
+        DELETE FROM students
+        WHERE deleted_at IS NOT NULL AND deleted_at <= datetime('now', ?) AND id IN ({ids})
+    ''', record_ids, chunk_size, params=(retention,))
+
+# Function to reclaim free pages and refresh query planner statistics
+# Cheap enough to run on a schedule while the app is serving requests
+def run_maintenance(vacuum_pages=1000):
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection (autocommit, transactions are opened explicitly)
+        conn = connect_db()
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        
+        # Free up to vacuum_pages unused pages in one transaction
+        # Python's sqlite3 steps a PRAGMA without result columns only once, and
+        # incremental_vacuum frees one page per step, so it is run once per page
+        free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        cursor.execute("BEGIN IMMEDIATE")
+        for _ in range(min(free_pages, int(vacuum_pages))):
+            cursor.execute("PRAGMA incremental_vacuum(1)")
+        cursor.execute("COMMIT")
+        # Let SQLite analyze tables whose statistics are out of date
+        cursor.execute("PRAGMA optimize")
+        
+        # Close connection
+        conn.close()
+
+# Function to check whether the database frees pages with incremental vacuum
+# Returns the auto_vacuum mode name: "none", "full" or "incremental"
+def get_auto_vacuum_mode():
+    # Establish database connection
+    conn = connect_db()
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    conn.close()
+    return {0: "none", 1: "full", 2: "incremental"}.get(mode, str(mode))
+
+# Function to switch an existing database to incremental vacuum (one-time migration)
+# The setting only applies after a full VACUUM, which rewrites the whole file and
+# blocks writers while it runs, so this is triggered explicitly by an admin
+# Returns True if the database was migrated, False if it already used incremental vacuum
+def enable_incremental_vacuum():
+    if get_auto_vacuum_mode() == "incremental":
+        return False
+    
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        
+        # VACUUM cannot run inside a transaction, so use autocommit for both statements
+        conn.isolation_level = None
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        
+        # Close connection
+        conn.close()
+    return True
+
+# Function to claim a named background job for this process
+# Returns True if the lease was acquired (or renewed), False if another process holds it
+def acquire_lease(name, ttl_seconds, owner=None):
+    """
+    Claim a job lease shared by every process using the database
+    
+    Args:
+        name (str): Job name, e.g. "maintenance"
+        ttl_seconds (float): How long the lease is held before others may take it
+        owner (str): Lease holder id (defaults to host:pid of this process)
+        
+    Returns:
+        bool: True if this process now holds the lease
+    """
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    now = time.time()
+    
+    # Wait for this process's turn in the write queue
+    with get_backend().write_turn():
+        # Establish database connection
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # Insert the lease, or take it over if it has expired or is already ours
+        cursor.execute('''
+            INSERT INTO job_leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE job_leases.expires_at <= ? OR job_leases.owner = excluded.owner
+        ''', (name, owner, now + ttl_seconds, now))
+        acquired = cursor.rowcount == 1
+        
+        # Commit changes and close connection
+        conn.commit()
+        conn.close()
+    return acquired
+
+# Function to copy the live database to a file while the app keeps running
+# Copies a few pages per step with a pause in between, so grading writes are not held up
+def backup_database(dest_path, pages_per_step=None, pause_seconds=None, progress=None):
+    """
+    Online backup using SQLite's backup API
+    
+    The copy is written to a temporary file and moved into place when
+    complete, so dest_path never holds a torn copy.
+    
+    Args:
+        dest_path (str): Where the backup is written
+        pages_per_step (int): Pages copied per step (defaults to BACKUP_PAGES_PER_STEP)
+        pause_seconds (float): Pause between steps (defaults to BACKUP_PAUSE_SECONDS)
+        progress (callable): Optional, called with (pages copied, total pages) after each step
+        
+    Returns:
+        str: dest_path
+    """
+    pages_per_step = pages_per_step or BACKUP_PAGES_PER_STEP
+    pause_seconds = BACKUP_PAUSE_SECONDS if pause_seconds is None else pause_seconds
+    # A unique temporary file per call, so concurrent backups to the same
+    # dest_path never write into each other's copy
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or ".", suffix=".tmp")
+    os.close(fd)
+    
+    def on_step(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+        if remaining:
+            time.sleep(pause_seconds)
+    
+    try:
+        # Establish connections to the live database and the new copy
+        source = connect_db()
+        target = sqlite3.connect(tmp_path)
+        try:
+            # In WAL mode, pin one read snapshot for the whole copy: writers carry on,
+            # and their commits do not force the backup to restart from the first page
+            if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                source.execute("BEGIN")
+                source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            source.backup(target, pages=pages_per_step, progress=on_step)
+            if source.in_transaction:
+                source.rollback()
+            
+            # Make the copy a self-contained file that can be opened read-only
+            target.execute("PRAGMA journal_mode = DELETE").fetchall()
+        finally:
+            target.close()
+            source.close()
+        
+        # Move the finished copy into place in one step
+        os.replace(tmp_path, dest_path)
+    finally:
+        # Only left behind if the copy failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dest_path
+
+# Function to write a timestamped backup into BACKUP_DIR
+# Keeps the newest BACKUP_KEEP backups and deletes older ones
+def create_backup(progress=None):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    dest_path = os.path.join(BACKUP_DIR, f"students-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    backup_database(dest_path, progress=progress)
+    
+    # Remove the oldest backups beyond the retention count
+    backups = sorted(name for name in os.listdir(BACKUP_DIR) if name.startswith("students-") and name.endswith(".db"))
+    for name in backups[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    return dest_path
+
+# Function to get the path of the read-only snapshot
+def get_snapshot_path():
+    return SNAPSHOT_PATH or f"{DB_PATH}.snapshot"
+
+# Function to refresh the read-only snapshot from the live database
+# Readers that have the old snapshot open keep using it until they reconnect
+def refresh_snapshot(progress=None):
+    return backup_database(get_snapshot_path(), progress=progress)
+
+# Function to get when the snapshot was last refreshed
+# Returns a datetime, or None if no snapshot exists yet
+def get_snapshot_time():
+    path = get_snapshot_path()
+    if not os.path.exists(path):
+        return None
+    return datetime.fromtimestamp(os.path.getmtime(path))
+
+# Function to open the read-only snapshot
+# Falls back to the live database when no snapshot has been taken yet
+def connect_snapshot():
+    path = get_snapshot_path()
+    if not os.path.exists(path):
+        return connect_db()
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
 
 # Function to retrieve all records from the database
 # Returns a list of all rows in the students table
-def get_all_records():
+# With use_snapshot=True the rows come from the read-only snapshot (may be slightly out of date)
+def get_all_records(use_snapshot=False):
     # Establish database connection
-    conn = connect_db()
+    conn = connect_snapshot() if use_snapshot else connect_db()
     cursor = conn.cursor()
     
-    # SQL to select all records
-    cursor.execute('SELECT * FROM students')
+    # SQL to select all live records (display columns only, submission text is not loaded)
+    cursor.execute(f'SELECT {RECORD_COLUMNS} FROM students WHERE deleted_at IS NULL')
     
     # Fetch all results as a list of tuples
     rows = cursor.fetchall()
@@ -115,3 +882,68 @@ def get_all_records():
     # Close connection and return data
     conn.close()
     return rows
+
+# Function to retrieve the most recently added record
+# Returns a single row or None when the table is empty
+def get_latest_record():
+    # Establish database connection
+    conn = connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to select the live record with the highest ID
+    cursor.execute(f'SELECT {RECORD_COLUMNS} FROM students WHERE deleted_at IS NULL ORDER BY id DESC LIMIT 1')
+    record = cursor.fetchone()
+    
+    # Close connection and return data
+    conn.close()
+    return record
+
+# Function to turn free text typed by a user into a safe FTS5 query
+# Every word is quoted so characters like '-', '*' or ':' are not parsed as FTS syntax
+def _build_fts_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"' for term in terms)
+
+# Function to search records by remarks and (optionally) submission text
+# Uses the FTS5 index and returns rows ranked by relevance (best match first)
+def search_records(query, include_submission_text=True, limit=50, use_snapshot=False):
+    """
+    Full-text search over remarks and submission text
+    
+    Args:
+        query (str): Words to look for, matched as an AND of all words
+        include_submission_text (bool): Also match the extracted submission text
+        limit (int): Maximum number of rows returned
+        use_snapshot (bool): Search the read-only snapshot instead of the live database
+        
+    Returns:
+        list: Rows of (id, teacher, email, student, grade, marks, remarks, snippet)
+    """
+    fts_query = _build_fts_query(query)
+    if not fts_query:
+        return []
+    
+    # Restrict the match to the remarks column unless submission text is included
+    if not include_submission_text:
+        fts_query = f"remarks : ({fts_query})"
+    
+    # Establish database connection
+    conn = connect_snapshot() if use_snapshot else connect_db()
+    cursor = conn.cursor()
+    
+    # SQL to match against the index, joined back to students for the display columns
+    # bm25() returns lower values for better matches, so ascending order ranks best first
+    cursor.execute('''
+        SELECT s.id, s.teacher_name, s.teacher_email, s.student_name, s.grade, s.marks, s.remarks,
+               snippet(students_fts, -1, '[', ']', '...', 12)
+        FROM students_fts
+        JOIN students s ON s.id = students_fts.rowid
+        WHERE students_fts MATCH ? AND s.deleted_at IS NULL
+        ORDER BY bm25(students_fts)
+        LIMIT ?
+    ''', (fts_query, limit))
+    rows = cursor.fetchall()
+    
+    # Close connection and return data
+    conn.close()
+    return rows
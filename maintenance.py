@@ -0,0 +1,93 @@
+import os
+import threading
+
+from database import (
+    acquire_lease, purge_deleted_records, run_maintenance,
+    create_backup, refresh_snapshot
+)
+
+# How often the background maintenance job runs (seconds)
+MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "3600"))
+# How long soft deleted records are kept before the purge removes them (days)
+SOFT_DELETE_RETENTION_DAYS = int(os.getenv("SOFT_DELETE_RETENTION_DAYS", "7"))
+# Maximum number of free pages returned to the OS per maintenance run
+VACUUM_PAGES_PER_RUN = int(os.getenv("VACUUM_PAGES_PER_RUN", "1000"))
+# How often an online backup is written (seconds, 0 disables scheduled backups)
+BACKUP_INTERVAL_SECONDS = int(os.getenv("BACKUP_INTERVAL_SECONDS", "86400"))
+# How often the read-only snapshot is refreshed (seconds, 0 disables scheduled refreshes)
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "300"))
+
+# Background thread state (one thread per job, per process)
+_scheduler_threads = {}
+_stop_event = threading.Event()
+_scheduler_lock = threading.Lock()
+
+def run_maintenance_cycle():
+    """
+    Run one round of database housekeeping
+
+    Purges soft deleted records past the retention period, then frees
+    unused pages and refreshes planner statistics. Every step works in
+    small transactions so grading writes are never blocked for long.
+
+    Returns:
+        int: Number of records purged
+    """
+    purged = purge_deleted_records(older_than_seconds=SOFT_DELETE_RETENTION_DAYS * 86400)
+    run_maintenance(vacuum_pages=VACUUM_PAGES_PER_RUN)
+    return purged
+
+def _scheduler_loop(name, interval_seconds, job):
+    # Wait first so starting the app does not immediately compete with user requests
+    while not _stop_event.wait(interval_seconds):
+        try:
+            # With several replicas only the holder of the lease runs this round
+            if not acquire_lease(name, interval_seconds):
+                continue
+            result = job()
+            print(f">>> Scheduled {name} finished: {result}")
+        except Exception as error:
+            # Keep the scheduler alive; the next run will try again
+            print(f"Scheduled {name} failed:", error)
+
+def start_maintenance_scheduler(interval_seconds=None):
+    """
+    Start the background jobs (maintenance, backup, snapshot refresh) if they are not already running
+
+    Streamlit re-executes app.py on every interaction, so this is safe to
+    call repeatedly; only the first call starts the threads.
+
+    Args:
+        interval_seconds (int): Seconds between maintenance runs (defaults to MAINTENANCE_INTERVAL_SECONDS)
+
+    Returns:
+        dict: Job name -> scheduler thread
+    """
+    jobs = {
+        "maintenance": (interval_seconds or MAINTENANCE_INTERVAL_SECONDS, run_maintenance_cycle),
+        "backup": (BACKUP_INTERVAL_SECONDS, create_backup),
+        "snapshot": (SNAPSHOT_INTERVAL_SECONDS, refresh_snapshot),
+    }
+    with _scheduler_lock:
+        _stop_event.clear()
+        for name, (interval, job) in jobs.items():
+            thread = _scheduler_threads.get(name)
+            if interval <= 0 or (thread is not None and thread.is_alive()):
+                continue
+            thread = threading.Thread(
+                target=_scheduler_loop,
+                args=(name, interval, job),
+                name=f"db-{name}",
+                daemon=True
+            )
+            thread.start()
+            _scheduler_threads[name] = thread
+        return dict(_scheduler_threads)
+
+def stop_maintenance_scheduler():
+    """Stop the background jobs (used by tests and shutdown hooks)"""
+    with _scheduler_lock:
+        _stop_event.set()
+        for thread in _scheduler_threads.values():
+            thread.join()
+        _scheduler_threads.clear()
@@ -0,0 +1,174 @@
+import threading
+import time
+
+# Adaptive model routing for grading
+# Short submissions are graded by a cheaper, faster model first. The result
+# is escalated to the large model only when it fails validation (no valid
+# grade or marks) or looks low-confidence: a letter grade that disagrees with
+# the marks, or marks on a letter-grade boundary. Long submissions go
+# straight to the large model.
+
+# Letter grade expected for a marks value: (lowest marks, grade)
+# The grading prompt states this scale (see describe_grade_bands), so a
+# mismatch between grade and marks means the model did not follow it
+GRADE_BANDS = [(90, "A"), (80, "B"), (70, "C"), (60, "D"), (0, "F")]
+
+
+class Route:
+    """
+    One model the router can send a request to
+
+    Args:
+        name (str): Route name used in the stats ("cheap", "large")
+        model (str): Model name passed to the backend
+        max_tokens (int): Response length limit for this route
+        input_price (float): Cost per 1K prompt tokens (USD)
+        output_price (float): Cost per 1K completion tokens (USD)
+    """
+
+    def __init__(self, name, model, max_tokens, input_price=0.0, output_price=0.0):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.input_price = input_price
+        self.output_price = output_price
+
+
+def expected_grade(marks):
+    """Letter grade matching a marks value according to GRADE_BANDS"""
+    for lowest, grade in GRADE_BANDS:
+        if marks >= lowest:
+            return grade
+    return "F"
+
+
+def describe_grade_bands():
+    """Grade scale as text for the grading prompt, e.g. A = 90-100, B = 80-89, ..., F = 0-59"""
+    parts = []
+    upper = 100
+    for lowest, grade in GRADE_BANDS:
+        parts.append(f"{grade} = {lowest}-{upper}")
+        upper = lowest - 1
+    return ", ".join(parts)
+
+
+def needs_escalation(grade, marks, remarks, margin):
+    """
+    Decide whether a cheap-model result should be redone by the large model
+
+    Args:
+        grade (str): Parsed letter grade
+        marks (int): Parsed marks
+        remarks (str): Parsed remarks
+        margin (int): Marks within this distance of a band boundary count as low
+            confidence (0 = only marks exactly on a boundary)
+
+    Returns:
+        str: Reason for escalating, or None if the result is accepted
+    """
+    letter = (grade or "").strip()[:1].upper()
+    if not letter or letter not in "ABCDF":
+        return "invalid grade"
+    if not 0 <= marks <= 100:
+        return "invalid marks"
+    if not remarks or remarks == "No remarks provided.":
+        return "missing remarks"
+    if letter != expected_grade(marks):
+        return "grade does not match marks"
+    if any(abs(marks - lowest) <= margin for lowest, _ in GRADE_BANDS if lowest > 0):
+        return "marks near a grade boundary"
+    return None
+
+
+class ModelRouter:
+    """
+    Cheap-first cascade for grading calls with per-route metrics
+
+    Args:
+        backend (callable): backend(model, messages, max_tokens) returns
+            (content, prompt_tokens, completion_tokens); swap in a stub for tests
+        parse (callable): Turns reply text into (grade, marks, remarks)
+        cheap (Route): Route tried first for short submissions
+        large (Route): Route for long submissions and escalations
+        short_text_chars (int): Submissions up to this length start on the cheap route
+        confidence_margin (int): Width of the low-confidence band around grade boundaries
+            (0 = only marks exactly on a boundary; every extra point escalates about
+            8% more of the 0-100 range)
+    """
+
+    def __init__(self, backend, parse, cheap, large, short_text_chars=6000, confidence_margin=0):
+        self.backend = backend
+        self.parse = parse
+        self.cheap = cheap
+        self.large = large
+        self.short_text_chars = short_text_chars
+        self.confidence_margin = confidence_margin
+        self._lock = threading.Lock()
+        self._stats = {route.name: self._empty_stats() for route in (cheap, large)}
+
+    @staticmethod
+    def _empty_stats():
+        return {"calls": 0, "errors": 0, "latency_seconds": 0.0, "cost_usd": 0.0, "escalations": 0}
+
+    def _call(self, route, messages):
+        # Call one route and record its latency and cost
+        start = time.monotonic()
+        try:
+            content, prompt_tokens, completion_tokens = self.backend(route.model, messages, route.max_tokens)
+        except Exception:
+            with self._lock:
+                self._stats[route.name]["calls"] += 1
+                self._stats[route.name]["errors"] += 1
+                self._stats[route.name]["latency_seconds"] += time.monotonic() - start
+            raise
+        cost = (prompt_tokens * route.input_price + completion_tokens * route.output_price) / 1000
+        with self._lock:
+            self._stats[route.name]["calls"] += 1
+            self._stats[route.name]["latency_seconds"] += time.monotonic() - start
+            self._stats[route.name]["cost_usd"] += cost
+        return content
+
+    def grade(self, text, messages):
+        """
+        Grade a submission, escalating from the cheap to the large model if needed
+
+        Args:
+            text (str): The submission text (used to pick the first route)
+            messages (list): Chat messages to send
+
+        Returns:
+            tuple: (grade, marks, remarks, route name that produced the result)
+        """
+        if len(text) <= self.short_text_chars:
+            try:
+                result = self.parse(self._call(self.cheap, messages))
+                if needs_escalation(*result, self.confidence_margin) is None:
+                    return (*result, self.cheap.name)
+            except Exception:
+                # A failing cheap call is escalated like a failed validation
+                pass
+            with self._lock:
+                self._stats[self.cheap.name]["escalations"] += 1
+        return (*self.parse(self._call(self.large, messages)), self.large.name)
+
+    def stats(self):
+        """
+        Per-route metrics for monitoring
+
+        Returns:
+            dict: For each route: calls, errors, average latency, total cost and
+                  (for the cheap route) escalations and escalation rate
+        """
+        with self._lock:
+            report = {}
+            for name, stats in self._stats.items():
+                calls = stats["calls"]
+                report[name] = {
+                    "calls": calls,
+                    "errors": stats["errors"],
+                    "avg_latency_seconds": stats["latency_seconds"] / calls if calls else 0.0,
+                    "cost_usd": stats["cost_usd"],
+                    "escalations": stats["escalations"],
+                    "escalation_rate": stats["escalations"] / calls if calls else 0.0,
+                }
+            return report
@@ -1,6 +1,11 @@
 import os
+import asyncio
+import hashlib
 from openai import OpenAI  # OpenAI API client for AI model access
 from dotenv import load_dotenv  # For loading environment variables from .env file
+from singleflight import SingleFlight
+from scheduler import grading_scheduler
+from model_router import ModelRouter, Route, describe_grade_bands
 
 # Load environment variables from .env file
 # This keeps API keys secure by not hardcoding them
@@ -16,16 +21,159 @@ else:
     client = unittest.mock.MagicMock()
     print("Warning: No OpenAI API key found. Using mock client.")
 
-def generate_teaching_material(topic):
+# Model used for grading and the response length limit
+# (with routing enabled this is the large model; short submissions try ROUTER_CHEAP_MODEL first,
+# and each record stores the model that actually produced its grade)
+GRADING_MODEL = "gpt-4o"
+GRADING_MAX_TOKENS = 300
+
+# Adaptive model routing for grading (see model_router.py)
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+ROUTER_CHEAP_MODEL = os.getenv("ROUTER_CHEAP_MODEL", "gpt-4o-mini")
+ROUTER_CHEAP_MAX_TOKENS = int(os.getenv("ROUTER_CHEAP_MAX_TOKENS", "200"))
+# Submissions up to this many characters start on the cheap model
+ROUTER_SHORT_TEXT_CHARS = int(os.getenv("ROUTER_SHORT_TEXT_CHARS", "6000"))
+# Marks within this distance of a grade boundary are escalated to the large model
+# (0 = only marks exactly on a boundary, e.g. 80 or 90)
+ROUTER_CONFIDENCE_MARGIN = int(os.getenv("ROUTER_CONFIDENCE_MARGIN", "0"))
+
+# Prompt used for grading; {text} is replaced by the assignment text
+# The grade scale comes from model_router.GRADE_BANDS, which the router checks results against
+GRADING_PROMPT_TEMPLATE = """
+    You are a strict but fair high school teacher. 
+    Grade the following assignment. Provide:
+
+    - A grade (A to F)
+    - Numeric marks (0 to 100)
+    - Constructive remarks
+
+    The grade must match the marks: """ + describe_grade_bands() + """
+
+    Important: Format your response exactly like this:
+    Grade: A
+    Marks: 85
+    Remarks: Your remarks here
+
+    Assignment text:
+    ---
+    {text}
+    """
+
+# Version of the grading prompt, stored with every graded record
+# Derived from the template so editing the prompt automatically marks older grades as stale
+GRADING_PROMPT_VERSION = hashlib.sha256(GRADING_PROMPT_TEMPLATE.encode("utf-8")).hexdigest()[:12]
+
+def routing_version(route_name):
+    """
+    Version of the model configuration that produced a grade, stored with every record
+    
+    A grade from the large model depends only on that model. A grade accepted
+    from the cheap model also depends on the cheap model and the escalation
+    settings, so changing any of those marks exactly those records as stale.
+    
+    Args:
+        route_name (str): "cheap" or "large" (see grading_router)
+        
+    Returns:
+        str: Short hash of the settings
+    """
+    if route_name == "cheap":
+        parts = ["cheap", ROUTER_CHEAP_MODEL, ROUTER_CHEAP_MAX_TOKENS, ROUTER_SHORT_TEXT_CHARS,
+                 ROUTER_CONFIDENCE_MARGIN, GRADING_MODEL]
+    else:
+        parts = ["large", GRADING_MODEL, GRADING_MAX_TOKENS]
+    return hashlib.sha256("\n".join(map(str, parts)).encode("utf-8")).hexdigest()[:12]
+
+
+def current_routing_versions():
+    """Routing versions the current settings can produce (grades with any other version are stale)"""
+    if ROUTER_ENABLED:
+        return [routing_version("large"), routing_version("cheap")]
+    return [routing_version("large")]
+
+
+def grading_metadata(route_name="large"):
+    """
+    Version columns stored with a grade produced by a route
+    
+    Args:
+        route_name (str): Route that produced the grade
+        
+    Returns:
+        dict: prompt_version, model and routing_version (keyword arguments of insert_record)
+    """
+    return {
+        "prompt_version": GRADING_PROMPT_VERSION,
+        "model": ROUTER_CHEAP_MODEL if route_name == "cheap" else GRADING_MODEL,
+        "routing_version": routing_version(route_name),
+    }
+
+
+def content_hash(text):
+    """
+    Fingerprint of the graded input, stored with every record
+    
+    Args:
+        text (str): The assignment text
+        
+    Returns:
+        str: SHA-256 hex digest of the text
+    """
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+# Concurrent identical requests (e.g. a whole class uploading the shared template)
+# share one in-flight API call instead of each making their own
+# Coalescing happens before the fair-share scheduler: only the leader of a call
+# queues for a grading slot, and followers wait without holding one
+_material_flight = SingleFlight()
+_grading_flight = SingleFlight()
+
+def get_coalescing_stats():
+    """
+    Request coalescing counters for monitoring (this process only, reset on restart)
+    
+    Returns:
+        dict: Stats per function, see SingleFlight.stats()
+    """
+    return {
+        "generate_teaching_material": _material_flight.stats(),
+        "grade_assignment": _grading_flight.stats(),
+    }
+
+def _scheduled(teacher, interactive, fn):
+    # Run fn through the fair-share scheduler on behalf of a teacher, or directly without one
+    if teacher is None:
+        return fn()
+    return grading_scheduler.run(teacher, fn, interactive=interactive)
+
+
+def generate_teaching_material(topic, teacher=None, interactive=True):
     """
     Generate educational teaching material using AI
     
+    Concurrent requests for the same topic share one API call.
+    
     Args:
         topic (str): The educational topic to create material about
+        teacher (str): Optional, queue the call in the fair-share scheduler for this teacher
+        interactive (bool): Scheduler class of the call (False for bulk work)
         
     Returns:
         str: The generated teaching material
     """
+    key = content_hash(topic.strip())
+    # The call is charged to the teacher whose request started it
+    return _material_flight.do(
+        key, lambda: _scheduled(teacher, interactive, lambda: _generate_teaching_material(topic))
+    )
+
+
+async def generate_teaching_material_async(topic):
+    """Async version of generate_teaching_material (coalesced with all other callers)"""
+    return await asyncio.to_thread(generate_teaching_material, topic)
+
+
+def _generate_teaching_material(topic):
     # Create a prompt asking the AI to generate educational content
     prompt = f"Create a detailed teaching material for the topic: {topic}. Include key concepts, explanations, and examples."
 
@@ -45,50 +193,49 @@ def generate_teaching_material(topic):
     return response.choices[0].message.content
 
 
-def grade_assignment(text):
+def build_grading_prompt(text):
     """
-    Grade an assignment or generated material using AI
+    Build the grading prompt for an assignment
     
     Args:
         text (str): The assignment text to grade
         
     Returns:
-        tuple: (grade, marks, remarks) containing the assessment
+        str: The prompt sent to the model
     """
-    # Create a detailed prompt instructing the AI how to grade
-    prompt = f"""
-    You are a strict but fair high school teacher. 
-    Grade the following assignment. Provide:
+    return GRADING_PROMPT_TEMPLATE.replace("{text}", text)
 
-    - A grade (A to F)
-    - Numeric marks (0 to 100)
-    - Constructive remarks
 
-    Important: Format your response exactly like this:
-    Grade: A
-    Marks: 85
-    Remarks: Your remarks here
-
-    Assignment text:
-    ---
-    {text}
+def build_grading_messages(text):
+    """
+    Build the chat messages for grading an assignment
+    
+    Shared by interactive grading and the offline batch pipeline.
+    
+    Args:
+        text (str): The assignment text to grade
+        
+    Returns:
+        list: Chat messages (system role and user prompt)
     """
+    return [
+        # Set system message to establish AI role
+        {"role": "system", "content": "You are an assignment evaluator."},
+        # Provide the user prompt with the assignment text
+        {"role": "user", "content": build_grading_prompt(text)}
+    ]
 
-    # Make API call to OpenAI for grading evaluation
-    response = client.chat.completions.create(
-        model="gpt-4o",  # Using GPT-4o model for better evaluation
-        messages=[
-            # Set system message to establish AI role
-            {"role": "system", "content": "You are an assignment evaluator."},
-            # Provide the user prompt with the assignment text
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=300  # Limit response length
-    )
 
-    # Extract response content
-    content = response.choices[0].message.content
+def parse_grading_response(content):
+    """
+    Parse the model's reply into grade, marks and remarks
     
+    Args:
+        content (str): Raw response text
+        
+    Returns:
+        tuple: (grade, marks, remarks), with defaults for missing lines
+    """
     # Initialize default values
     grade = "N/A"
     marks = 0
@@ -119,3 +266,92 @@ def grade_assignment(text):
     
     # Return the extracted grade, marks, and remarks as a tuple
     return grade, marks, remarks
+
+
+def grade_assignment(text):
+    """
+    Grade an assignment or generated material using AI
+    
+    Concurrent requests for the same text share one API call.
+    
+    Args:
+        text (str): The assignment text to grade
+        
+    Returns:
+        tuple: (grade, marks, remarks) containing the assessment
+    """
+    return grade_assignment_routed(text)[:3]
+
+
+def grade_assignment_routed(text, teacher=None, interactive=True):
+    """
+    Grade an assignment and report which model produced the grade
+    
+    Same as grade_assignment, plus the version columns to store with the
+    record (with routing enabled the grade may come from the cheap model).
+    
+    Args:
+        text (str): The assignment text to grade
+        teacher (str): Optional, queue the call in the fair-share scheduler for this teacher
+        interactive (bool): Scheduler class of the call (False for bulk work such as regrading)
+        
+    Returns:
+        tuple: (grade, marks, remarks, metadata) where metadata is grading_metadata(route)
+    """
+    # The key covers everything that affects the result, not just the text
+    key = content_hash(f"{GRADING_PROMPT_VERSION}\n{','.join(current_routing_versions())}\n{text}")
+    # The call is charged to the teacher whose request started it
+    return _grading_flight.do(key, lambda: _scheduled(teacher, interactive, lambda: _grade_assignment(text)))
+
+
+async def grade_assignment_async(text):
+    """Async version of grade_assignment (coalesced with all other callers)"""
+    return await asyncio.to_thread(grade_assignment, text)
+
+
+def _grade_assignment(text):
+    # Route the grading call: cheap model first for short texts, escalating when needed
+    if ROUTER_ENABLED:
+        grade, marks, remarks, route_name = grading_router.grade(text, build_grading_messages(text))
+        return grade, marks, remarks, grading_metadata(route_name)
+
+    # Make API call to OpenAI for grading evaluation
+    response = client.chat.completions.create(
+        model=GRADING_MODEL,  # Using GPT-4o model for better evaluation
+        messages=build_grading_messages(text),
+        max_tokens=GRADING_MAX_TOKENS  # Limit response length
+    )
+
+    # Extract response content and parse it
+    content = response.choices[0].message.content
+    return (*parse_grading_response(content), grading_metadata("large"))
+
+
+def _openai_backend(model, messages, max_tokens):
+    # Backend used by the router: one chat completion call, returning text and token usage
+    response = client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens)
+    usage = getattr(response, "usage", None)
+    prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+    completion_tokens = int(getattr(usage, "completion_tokens", 0) or 0)
+    return response.choices[0].message.content, prompt_tokens, completion_tokens
+
+
+# Router used by grade_assignment (prices are USD per 1K tokens, used for the cost metric)
+grading_router = ModelRouter(
+    backend=_openai_backend,
+    parse=parse_grading_response,
+    cheap=Route("cheap", ROUTER_CHEAP_MODEL, ROUTER_CHEAP_MAX_TOKENS, input_price=0.00015, output_price=0.0006),
+    large=Route("large", GRADING_MODEL, GRADING_MAX_TOKENS, input_price=0.0025, output_price=0.01),
+    short_text_chars=ROUTER_SHORT_TEXT_CHARS,
+    confidence_margin=ROUTER_CONFIDENCE_MARGIN
+)
+
+
+def get_routing_stats():
+    """
+    Per-route latency, cost and escalation metrics for grading (this process only, reset on restart)
+
+    Returns:
+        dict: Stats per route, see ModelRouter.stats()
+    """
+    return grading_router.stats()
@@ -0,0 +1,192 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+import fitz  # PyMuPDF library for PDF processing
+
+try:
+    import resource  # Unix only, used to cap the worker's memory
+except ImportError:
+    resource = None
+
+# Guarded PDF extraction
+# Untrusted uploads are parsed in a separate worker process with limits on
+# file size, page count, extracted text, time per page and memory, so a huge
+# or malicious PDF kills the worker instead of the Streamlit replica.
+
+# Largest accepted PDF file (bytes)
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(50 * 1024 * 1024)))
+# Largest accepted page count
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "300"))
+# Extraction stops once the text reaches this many tokens (about 4 characters each)
+PDF_MAX_TOKENS = int(os.getenv("PDF_MAX_TOKENS", "20000"))
+# Longest time a single page may take to extract (seconds)
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT_SECONDS", "10"))
+# Extra memory the worker may allocate while parsing (MB)
+PDF_MAX_MEMORY_MB = int(os.getenv("PDF_MAX_MEMORY_MB", "512"))
+
+# Rough number of characters per token, used to turn the token budget into a text length
+CHARS_PER_TOKEN = 4
+
+
+class PDFExtractionError(Exception):
+    """Raised when a PDF is rejected or cannot be extracted within the limits"""
+
+
+def _limit_memory(max_memory_mb):
+    # Cap the worker's address space at its current size plus the budget,
+    # which also bounds how far its resident memory can grow
+    if resource is None:
+        return
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = 0
+    limit = current + max_memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Stream the worker's messages are written to (set up by the __main__ block)
+_channel = sys.stdout
+
+
+def _send(message):
+    # One JSON message per line, read by extract_text_guarded
+    _channel.write(json.dumps(message) + "\n")
+    _channel.flush()
+
+
+def _extract_worker(file_path, max_pages, max_chars, max_memory_mb):
+    # Runs in the worker process; reports progress after every page so the
+    # parent can enforce the per-page timeout, then sends the result
+    try:
+        _limit_memory(max_memory_mb)
+        doc = fitz.open(file_path)
+        if doc.needs_pass:
+            _send(["error", "The PDF is password protected."])
+            return
+        if doc.page_count > max_pages:
+            _send(["error", f"The PDF has {doc.page_count} pages; the limit is {max_pages}."])
+            return
+
+        parts = []
+        length = 0
+        truncated = False
+        for page_number in range(doc.page_count):
+            _send(["page", page_number])
+            text = doc.load_page(page_number).get_text()
+
+            # Stop as soon as the token budget is used up
+            if length + len(text) >= max_chars:
+                parts.append(text[:max_chars - length])
+                truncated = page_number < doc.page_count - 1 or length + len(text) > max_chars
+                break
+            parts.append(text)
+            length += len(text)
+
+        _send(["done", "".join(parts), truncated])
+    except MemoryError:
+        _send(["error", f"The PDF needs more than {max_memory_mb} MB of memory to extract."])
+    except Exception as error:
+        _send(["error", f"The PDF could not be read: {error}"])
+
+
+def _read_messages(stream, messages):
+    # Forward the worker's messages to a queue; None marks the end of the output
+    # Other lines (e.g. warnings printed while fitz is imported, before the
+    # worker redirects stdout) are skipped
+    for line in stream:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(message, list) and message:
+            messages.put(message)
+    messages.put(None)
+
+
+def extract_text_guarded(file_path, max_bytes=None, max_pages=None, max_tokens=None,
+                         page_timeout=None, max_memory_mb=None):
+    """
+    Extract text from an untrusted PDF within size, time and memory limits
+
+    Args:
+        file_path (str): Path to the PDF file
+        max_bytes (int): Largest accepted file size (defaults to PDF_MAX_BYTES)
+        max_pages (int): Largest accepted page count (defaults to PDF_MAX_PAGES)
+        max_tokens (int): Text budget; extraction stops early once it is reached
+        page_timeout (float): Seconds allowed per page before the worker is killed
+        max_memory_mb (int): Memory the worker may allocate while parsing
+
+    Returns:
+        tuple: (text, truncated) where truncated is True if the budget cut the text short
+
+    Raises:
+        PDFExtractionError: If the file breaks a limit or cannot be parsed
+    """
+    max_bytes = max_bytes or PDF_MAX_BYTES
+    max_pages = max_pages or PDF_MAX_PAGES
+    max_chars = (max_tokens or PDF_MAX_TOKENS) * CHARS_PER_TOKEN
+    page_timeout = page_timeout or PDF_PAGE_TIMEOUT_SECONDS
+    max_memory_mb = max_memory_mb or PDF_MAX_MEMORY_MB
+
+    # Reject oversized files before any parsing happens
+    size = os.path.getsize(file_path)
+    if size > max_bytes:
+        raise PDFExtractionError(
+            f"The PDF is {size / 1024 / 1024:.1f} MB; the limit is {max_bytes / 1024 / 1024:.0f} MB."
+        )
+
+    # The worker is this module run as a script in a fresh interpreter: nothing
+    # from the calling program (e.g. app.py under streamlit run) is imported
+    # again, and the threaded server is not forked
+    worker = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), os.path.abspath(file_path),
+         str(max_pages), str(max_chars), str(max_memory_mb)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+    messages = queue.Queue()
+    reader = threading.Thread(target=_read_messages, args=(worker.stdout, messages), daemon=True)
+    reader.start()
+
+    page_number = None
+    try:
+        while True:
+            # Every page must report within the timeout (opening the file counts as the first step)
+            try:
+                message = messages.get(timeout=page_timeout)
+            except queue.Empty:
+                where = "opening the file" if page_number is None else f"page {page_number + 1}"
+                raise PDFExtractionError(f"Extraction timed out on {where} after {page_timeout:g} seconds.")
+            if message is None:
+                # The worker died without reporting, e.g. killed by the memory limit
+                raise PDFExtractionError("The PDF could not be extracted within the memory limit.")
+
+            if message[0] == "page":
+                page_number = message[1]
+            elif message[0] == "done":
+                return message[1], message[2]
+            else:
+                raise PDFExtractionError(message[1])
+    finally:
+        if worker.poll() is None:
+            worker.kill()
+        worker.wait()
+        reader.join()
+        worker.stdout.close()
+
+
+if __name__ == "__main__":
+    # Worker entry point: pdf_guard.py <file> <max pages> <max chars> <max memory MB>
+    # Messages get a private copy of stdout; anything else printing to stdout
+    # (e.g. library warnings) is sent to stderr so it cannot corrupt the protocol
+    _channel = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    _extract_worker(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
@@ -0,0 +1,134 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from database import get_stale_records, update_grade
+from openai_utils import GRADING_PROMPT_VERSION, content_hash, current_routing_versions, grade_assignment_routed
+
+# Regrading settings: how many rows are graded per batch, how many API calls
+# run at once, and the minimum gap between starting two API calls
+REGRADE_BATCH_SIZE = 20
+REGRADE_MAX_WORKERS = 4
+REGRADE_MIN_INTERVAL_SECONDS = 0.2
+
+
+class _Throttle:
+    # Spaces out calls across threads so at most one starts every interval seconds
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def plan_regrade(prompt_version=GRADING_PROMPT_VERSION, routing_versions=None, text_loader=None):
+    """
+    Select the records that need regrading
+
+    A record is stale when its prompt version differs from the current one,
+    or it was graded under model routing settings that are no longer in use.
+    The stored submission text is reused; records without it are
+    re-extracted with text_loader when one is given.
+
+    Args:
+        prompt_version (str): Current grading prompt version
+        routing_versions (list): Current routing versions (defaults to current_routing_versions())
+        text_loader (callable): Optional, called with a record ID, returns the
+            submission text (e.g. by re-extracting an archived PDF) or None
+
+    Returns:
+        dict: "jobs" maps content hash -> {"text": str, "records": [row, ...]},
+              "missing_text" lists IDs of stale records with no text available
+    """
+    jobs = {}
+    missing_text = []
+    if routing_versions is None:
+        routing_versions = current_routing_versions()
+    for row in get_stale_records(prompt_version, routing_versions):
+        record_id, text = row[0], row[6]
+        if not text and text_loader is not None:
+            text = text_loader(record_id)
+        if not text:
+            missing_text.append(record_id)
+            continue
+
+        # Records with identical text share a single grading call
+        key = content_hash(text)
+        jobs.setdefault(key, {"text": text, "records": []})["records"].append(row)
+    return {"jobs": jobs, "missing_text": missing_text}
+
+
+def run_regrade(plan, grader=grade_assignment_routed, batch_size=REGRADE_BATCH_SIZE,
+                max_workers=REGRADE_MAX_WORKERS, min_interval_seconds=REGRADE_MIN_INTERVAL_SECONDS):
+    """
+    Regrade the records selected by plan_regrade and write the results back
+
+    Work is split into batches; each batch runs concurrently on a thread
+    pool, with API calls throttled and queued by the grader as bulk work in
+    the fair-share scheduler (charged to the record's teacher). Each batch is written to
+    the database before the next starts, so an interrupted run keeps the
+    finished part (those rows are no longer stale). A failing grading call
+    only affects the records sharing its text: they are reported with the
+    error and stay stale, while every other result is still written.
+
+    Args:
+        plan (dict): Result of plan_regrade()
+        grader (callable): Called as grader(text, teacher=..., interactive=False),
+            returns (grade, marks, remarks, metadata) where metadata holds the
+            prompt_version, model and routing_version recorded on the updated records
+        batch_size (int): Distinct texts graded per batch
+        max_workers (int): Concurrent grading calls
+        min_interval_seconds (float): Minimum gap between starting two calls
+
+    Returns:
+        list: One dict per record with old and new grade and marks, the
+              marks change, whether the grade changed, and the error message
+              if grading failed (None otherwise; new grade and marks are None then)
+    """
+    throttle = _Throttle(min_interval_seconds)
+
+    def grade_job(key):
+        throttle.wait()
+        job = plan["jobs"][key]
+        teacher_email = job["records"][0][1]
+        return grader(job["text"], teacher=teacher_email, interactive=False)
+
+    report = []
+    keys = list(plan["jobs"])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(keys), batch_size):
+            futures = {executor.submit(grade_job, key): key for key in keys[start:start + batch_size]}
+            # Results are written as each call finishes; one failure does not discard the others
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    grade, marks, remarks, metadata = future.result()
+                    error = None
+                except Exception as exc:
+                    grade = marks = None
+                    error = str(exc) or type(exc).__name__
+                for row in plan["jobs"][key]["records"]:
+                    record_id, _, student_name, old_grade, old_marks = row[:5]
+                    if error is None:
+                        update_grade(record_id, grade, marks, remarks, metadata["prompt_version"],
+                                     metadata["model"], key, metadata["routing_version"])
+                    report.append({
+                        "id": record_id,
+                        "student_name": student_name,
+                        "old_grade": old_grade,
+                        "new_grade": grade,
+                        "old_marks": old_marks,
+                        "new_marks": marks,
+                        "marks_change": None if error else (marks or 0) - (old_marks or 0),
+                        "grade_changed": error is None and old_grade != grade,
+                        "error": error,
+                    })
+    report.sort(key=lambda row: row["id"])
+    return report
@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# Fair-share scheduling of grading calls across teachers
+# All grading shares one API quota, so calls are queued per teacher and
+# dispatched by weighted fair queuing: every job gets a virtual finish tag,
+# and the job with the smallest tag runs next. A teacher who queues 300 bulk
+# jobs therefore cannot delay another teacher's single request by more than
+# about one job. Interactive requests always go before bulk ones, and each
+# teacher is limited to a number of concurrently running calls.
+# All of this is per process: each replica of the app has its own scheduler,
+# capacity and queues, so with N replicas up to N * GRADING_CAPACITY calls run
+# at once and fairness only holds between teachers served by the same replica.
+
+# Total grading calls running at once (the shared capacity)
+GRADING_CAPACITY = int(os.getenv("GRADING_CAPACITY", "4"))
+# Calls a single teacher may have running at once
+GRADING_PER_TEACHER_LIMIT = int(os.getenv("GRADING_PER_TEACHER_LIMIT", "2"))
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+class _Job:
+    def __init__(self, teacher, fn, finish_tag):
+        self.teacher = teacher
+        self.fn = fn
+        self.finish_tag = finish_tag
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class FairShareScheduler:
+    """
+    Weighted fair queue of grading calls keyed by teacher
+
+    Args:
+        capacity (int): Worker threads, i.e. calls running at once
+        per_teacher_limit (int): Running calls allowed per teacher
+        weights (dict): Optional teacher -> weight; a weight of 2 gets twice the share
+    """
+
+    def __init__(self, capacity=GRADING_CAPACITY, per_teacher_limit=GRADING_PER_TEACHER_LIMIT, weights=None):
+        self.capacity = capacity
+        self.per_teacher_limit = per_teacher_limit
+        self.weights = weights or {}
+        self._condition = threading.Condition()
+        self._queues = {}        # (teacher, class) -> deque of jobs
+        self._last_finish = {}   # (teacher, class) -> finish tag of the last queued job
+        self._virtual_time = 0.0
+        self._running = {}       # teacher -> running calls
+        self._wait_stats = {}    # teacher -> [jobs started, total wait, max wait]
+        self._workers = []
+        self._stopped = False
+
+    def _start_workers(self):
+        # Workers are started on first use so importing the module has no side effects
+        while len(self._workers) < self.capacity:
+            worker = threading.Thread(target=self._worker_loop, name="grading-scheduler", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, teacher, fn, interactive=True):
+        """
+        Queue a call on behalf of a teacher
+
+        Args:
+            teacher (str): Teacher the work is charged to (teacher_email)
+            fn (callable): The grading call to run
+            interactive (bool): True for a user waiting on the page, False for bulk work
+
+        Returns:
+            Future: Resolves to the result of fn()
+        """
+        job_class = INTERACTIVE if interactive else BULK
+        key = (teacher, job_class)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Scheduler has been shut down")
+            # Start tag: now, or right after this teacher's previous job in this class
+            start_tag = max(self._virtual_time, self._last_finish.get(key, 0.0))
+            finish_tag = start_tag + 1.0 / self.weights.get(teacher, 1.0)
+            self._last_finish[key] = finish_tag
+            job = _Job(teacher, fn, finish_tag)
+            self._queues.setdefault(key, deque()).append(job)
+            self._start_workers()
+            self._condition.notify()
+        return job.future
+
+    def run(self, teacher, fn, interactive=True):
+        """Queue a call and wait for its result (see submit)"""
+        return self.submit(teacher, fn, interactive).result()
+
+    def _next_job(self):
+        # Pick the queued job with the smallest finish tag, interactive first,
+        # skipping teachers that already use their full concurrency
+        for job_class in (INTERACTIVE, BULK):
+            best_key = None
+            for key, queue in self._queues.items():
+                teacher, queue_class = key
+                if queue_class != job_class or not queue:
+                    continue
+                if self._running.get(teacher, 0) >= self.per_teacher_limit:
+                    continue
+                if best_key is None or queue[0].finish_tag < self._queues[best_key][0].finish_tag:
+                    best_key = key
+            if best_key is not None:
+                job = self._queues[best_key].popleft()
+                self._virtual_time = max(self._virtual_time, job.finish_tag - 1.0 / self.weights.get(job.teacher, 1.0))
+                return job
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if self._stopped:
+                        return
+                    self._condition.wait()
+                    job = self._next_job()
+                self._running[job.teacher] = self._running.get(job.teacher, 0) + 1
+                wait = time.monotonic() - job.enqueued_at
+                stats = self._wait_stats.setdefault(job.teacher, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += wait
+                stats[2] = max(stats[2], wait)
+
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.fn())
+                    except BaseException as error:
+                        # Any failure (including SystemExit / KeyboardInterrupt raised by fn)
+                        # goes to the caller; the worker thread keeps serving the queue
+                        job.future.set_exception(error)
+            finally:
+                with self._condition:
+                    self._running[job.teacher] -= 1
+                    # A slot for this teacher (and the shared capacity) is free again
+                    self._condition.notify_all()
+
+    def stats(self):
+        """
+        Queue depth and wait times per teacher (this process only)
+
+        Returns:
+            dict: teacher -> queued_interactive, queued_bulk, running,
+                  started, avg_wait_seconds, max_wait_seconds, oldest_wait_seconds
+        """
+        now = time.monotonic()
+        with self._condition:
+            teachers = {teacher for teacher, _ in self._queues} | set(self._running) | set(self._wait_stats)
+            report = {}
+            for teacher in sorted(teachers):
+                interactive = self._queues.get((teacher, INTERACTIVE), deque())
+                bulk = self._queues.get((teacher, BULK), deque())
+                started, total_wait, max_wait = self._wait_stats.get(teacher, [0, 0.0, 0.0])
+                oldest = min((queue[0].enqueued_at for queue in (interactive, bulk) if queue), default=now)
+                report[teacher] = {
+                    "queued_interactive": len(interactive),
+                    "queued_bulk": len(bulk),
+                    "running": self._running.get(teacher, 0),
+                    "started": started,
+                    "avg_wait_seconds": total_wait / started if started else 0.0,
+                    "max_wait_seconds": max_wait,
+                    "oldest_wait_seconds": now - oldest,
+                }
+            return report
+
+    def shutdown(self):
+        """Stop the workers once the queues are empty"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+# Scheduler shared by every grading call in this process
+grading_scheduler = FairShareScheduler()
@@ -0,0 +1,86 @@
+import threading
+
+# Single-flight request coalescing
+# When several callers ask for the same key at the same time, only the first
+# one (the leader) runs the function; the others wait for it and receive the
+# same result or exception. Nothing is cached once the call has finished.
+
+
+class _Call:
+    # One in-flight call and the outcome shared with every waiter
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Share one in-flight call between concurrent identical requests
+
+    Works across threads; asyncio code gets the same behaviour by running
+    the call in a worker thread (e.g. asyncio.to_thread), since waiting
+    tasks then wait on the same in-flight call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Run fn() unless a call with the same key is already in flight
+
+        Args:
+            key (str): Identity of the request (e.g. a content hash)
+            fn (callable): Function doing the real work
+
+        Returns:
+            object: The result of fn(), shared by all coalesced callers
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        # Followers wait for the leader and reuse its outcome
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as error:
+            # Includes KeyboardInterrupt / SystemExit, so followers never get a silent None
+            call.error = error
+            raise
+        finally:
+            # Later requests with this key start a new call
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        Counters for monitoring
+
+        Returns:
+            dict: executed (real calls), coalesced (requests that shared a call)
+                  and in_flight (calls currently running)
+        """
+        with self._lock:
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
@@ -7,7 +7,11 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import database functions to test
-from database import connect_db, create_students_table, insert_record, get_all_records
+from database import connect_db, create_students_table, insert_record, get_all_records, search_records
+import database
+import storage
+import multiprocessing
+import threading
 
 # Mock Streamlit before importing app
 import sys
@@ -39,6 +43,16 @@ builtins.__import__ = mock_import
 
 # Now it's safe to import our OpenAI-dependent modules
 from openai_utils import generate_teaching_material, grade_assignment
+import openai_utils
+import regrade
+import pdf_guard
+import asyncio
+import time
+from singleflight import SingleFlight
+import json
+import batch_grading
+from model_router import GRADE_BANDS, ModelRouter, Route, expected_grade, needs_escalation
+from scheduler import FairShareScheduler
 
 # Extract the validate_email function directly without importing the whole app
 # This avoids Streamlit initialization issues
@@ -114,7 +128,7 @@ class TestDatabase:
         assert "INSERT INTO students" in sql_query
         # Check second argument (should be tuple of values)
         params = mock_cursor.execute.call_args[0][1]
-        assert params == (teacher_name, teacher_email, student_name, grade, marks, remarks)
+        assert params == (teacher_name, teacher_email, student_name, grade, marks, remarks, None, None, None, None, None)
         
         # Verify commit and close were called
         assert mock_conn.commit.called
@@ -140,7 +154,9 @@ class TestDatabase:
         result = get_all_records()
         
         # Verify the SQL query
-        mock_cursor.execute.assert_called_once_with('SELECT * FROM students')
+        mock_cursor.execute.assert_called_once_with(
+            'SELECT id, teacher_name, teacher_email, student_name, grade, marks, remarks FROM students WHERE deleted_at IS NULL'
+        )
         # Verify fetchall was called
         assert mock_cursor.fetchall.called
         # Verify the returned records match our mock data
@@ -148,6 +164,412 @@ class TestDatabase:
         # Verify connection was closed
         assert mock_conn.close.called
 
+# Point the database module at a fresh file for tests that need a real database
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "students.db")
+    monkeypatch.setattr(database, "DB_PATH", db_path)
+    create_students_table()
+    return db_path
+
+# Test full-text search against a real temporary database
+@pytest.mark.usefixtures("temp_db")
+class TestSearch:
+    def test_search_matches_remarks_and_ranks(self):
+        insert_record("T", "t@gmail.com", "Ann", "A", 95, "Excellent thesis and thesis support")
+        insert_record("T", "t@gmail.com", "Bob", "C", 70, "Weak thesis")
+        insert_record("T", "t@gmail.com", "Cat", "B", 85, "Good structure")
+        
+        results = search_records("thesis")
+        
+        # Only matching rows are returned, best match first
+        assert [row[3] for row in results] == ["Ann", "Bob"]
+    
+    def test_search_submission_text_is_optional(self):
+        insert_record("T", "t@gmail.com", "Ann", "A", 95, "Great work", submission_text="photosynthesis essay")
+        
+        assert len(search_records("photosynthesis")) == 1
+        assert search_records("photosynthesis", include_submission_text=False) == []
+    
+    def test_search_index_follows_updates_and_deletes(self):
+        record_id = insert_record("T", "t@gmail.com", "Ann", "A", 95, "Great work")
+        conn = connect_db()
+        conn.execute("UPDATE students SET remarks = 'Sloppy citations' WHERE id = ?", (record_id,))
+        conn.commit()
+        conn.close()
+        
+        assert search_records("great") == []
+        assert len(search_records("citations")) == 1
+        
+        database.delete_record_by_id(record_id)
+        assert search_records("citations") == []
+    
+    def test_search_ignores_fts_syntax(self):
+        insert_record("T", "t@gmail.com", "Ann", "A", 95, "Well-argued: see NOT this")
+        
+        # Operators and punctuation typed by a user must not raise
+        assert len(search_records('well-argued: "NOT')) == 1
+        assert search_records("   ") == []
+
+# Test bulk deletes, soft delete and maintenance against a real temporary database
+@pytest.mark.usefixtures("temp_db")
+class TestBulkOperations:
+    def _insert(self, count, teacher_email="t@gmail.com", grade="B"):
+        return [insert_record("T", teacher_email, f"S{i}", grade, 80, "ok") for i in range(count)]
+    
+    def test_soft_delete_hides_and_restore_brings_back(self):
+        ids = self._insert(5)
+        
+        assert database.soft_delete_records(ids[:3], chunk_size=2) == 3
+        assert [row[0] for row in get_all_records()] == ids[3:]
+        
+        assert database.restore_records(ids[:1]) == 1
+        assert [row[0] for row in get_all_records()] == [ids[0]] + ids[3:]
+    
+    def test_delete_latest_skips_already_deleted(self):
+        ids = self._insert(3)
+        database.delete_latest_record()
+        database.delete_latest_record()
+        
+        assert database.get_latest_record()[0] == ids[0]
+    
+    def test_delete_matching_filters(self):
+        keep = self._insert(2, teacher_email="a@gmail.com")
+        self._insert(3, teacher_email="b@gmail.com", grade="F")
+        
+        assert database.delete_records_matching(teacher_email="b@gmail.com", grade="F") == 3
+        assert [row[0] for row in get_all_records()] == keep
+        
+        # An empty filter must not wipe the table
+        with pytest.raises(ValueError):
+            database.delete_records_matching()
+    
+    def test_clear_and_purge_remove_rows_in_chunks(self, monkeypatch):
+        monkeypatch.setattr(database, "DELETE_CHUNK_SIZE", 4)
+        self._insert(10)
+        
+        assert database.clear_students_table() == 10
+        assert get_all_records() == []
+        
+        # Recently deleted rows survive a purge with a retention period
+        assert database.purge_deleted_records(older_than_seconds=3600) == 0
+        assert database.purge_deleted_records() == 10
+        assert database.find_record_ids(include_deleted=True) == []
+    
+    def test_purge_keeps_records_restored_mid_purge(self, monkeypatch):
+        ids = self._insert(4)
+        database.soft_delete_records(ids)
+        
+        # Restore the last record while the purge pauses between chunks
+        def restore_during_pause(seconds):
+            database.restore_records([ids[-1]])
+        monkeypatch.setattr(database.time, "sleep", restore_during_pause)
+        
+        assert database.purge_deleted_records(chunk_size=2) == 3
+        assert [row[0] for row in get_all_records()] == [ids[-1]]
+    
+    def test_hard_delete_matching_rechecks_filter(self, monkeypatch):
+        ids = self._insert(4, grade="F")
+        
+        # Regrade one record while the delete pauses between chunks
+        def regrade_during_pause(seconds):
+            database.update_grade(ids[-1], "B", 85, "better", None, None, None)
+        monkeypatch.setattr(database.time, "sleep", regrade_during_pause)
+        monkeypatch.setattr(database, "DELETE_CHUNK_SIZE", 2)
+        
+        assert database.delete_records_matching(grade="F", soft=False) == 3
+        assert database.find_record_ids(include_deleted=True) == [ids[-1]]
+    
+    def _page_counts(self):
+        conn = connect_db()
+        counts = (conn.execute("PRAGMA page_count").fetchone()[0],
+                  conn.execute("PRAGMA freelist_count").fetchone()[0])
+        conn.close()
+        return counts
+    
+    def _fill_and_delete(self):
+        for i in range(50):
+            insert_record("T", "t@gmail.com", f"S{i}", "B", 80, "ok", submission_text="essay " * 2000)
+        database.hard_delete_records(database.find_record_ids())
+    
+    def test_run_maintenance_frees_pages(self):
+        assert database.get_auto_vacuum_mode() == "incremental"
+        self._fill_and_delete()
+        pages_before, free_before = self._page_counts()
+        assert free_before > 0
+        
+        database.run_maintenance()
+        pages_after, free_after = self._page_counts()
+        assert free_after == 0
+        assert pages_after < pages_before
+    
+    def test_enable_incremental_vacuum_migrates_old_database(self, tmp_path, monkeypatch):
+        # A database file created before incremental vacuum existed
+        db_path = str(tmp_path / "old.db")
+        conn = database.sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE legacy (x)")
+        conn.close()
+        monkeypatch.setattr(database, "DB_PATH", db_path)
+        create_students_table()
+        assert database.get_auto_vacuum_mode() == "none"
+        
+        # Without the migration, maintenance cannot free anything
+        self._fill_and_delete()
+        database.run_maintenance()
+        assert self._page_counts()[1] > 0
+        
+        assert database.enable_incremental_vacuum() is True
+        assert database.enable_incremental_vacuum() is False
+        assert database.get_auto_vacuum_mode() == "incremental"
+        
+        # Afterwards deleted pages are returned by the scheduled maintenance
+        self._fill_and_delete()
+        pages_before, free_before = self._page_counts()
+        assert free_before > 0
+        database.run_maintenance()
+        pages_after, free_after = self._page_counts()
+        assert free_after == 0
+        assert pages_after < pages_before
+
+# Test online backups and read-only snapshots against a real temporary database
+@pytest.mark.usefixtures("temp_db")
+class TestBackupAndSnapshot:
+    def test_backup_runs_alongside_writers(self, tmp_path):
+        for i in range(300):
+            insert_record("T", "t@gmail.com", f"S{i}", "B", 80, "x" * 500)
+        
+        # Keep inserting from another thread while the backup copies a few pages at a time
+        stop = threading.Event()
+        written = []
+        def writer():
+            while not stop.is_set():
+                written.append(insert_record("T", "t@gmail.com", "Live", "A", 95, "during backup"))
+        thread = threading.Thread(target=writer)
+        thread.start()
+        steps = []
+        dest = str(tmp_path / "backup.db")
+        database.backup_database(dest, pages_per_step=5, pause_seconds=0.005,
+                                 progress=lambda done, total: steps.append((done, total)))
+        stop.set()
+        thread.join()
+        
+        # Writers made progress during the copy, and the copy is a complete, consistent file
+        assert len(steps) > 1 and written
+        conn = database.sqlite3.connect(dest)
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert conn.execute("SELECT COUNT(*) FROM students").fetchone()[0] >= 300
+        conn.close()
+    
+    def test_concurrent_backups_to_the_same_path(self, tmp_path):
+        for i in range(100):
+            insert_record("T", "t@gmail.com", f"S{i}", "B", 80, "x" * 500)
+        dest = str(tmp_path / "snapshot.db")
+        
+        # Two refreshes at once each write their own temporary copy
+        errors = []
+        def backup():
+            try:
+                database.backup_database(dest, pages_per_step=5, pause_seconds=0.005)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=backup) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert errors == []
+        assert os.path.exists(dest)
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+        conn = database.sqlite3.connect(dest)
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert conn.execute("SELECT COUNT(*) FROM students").fetchone()[0] == 100
+        conn.close()
+    
+    def test_failed_backup_removes_temporary_file(self, tmp_path):
+        insert_record("T", "t@gmail.com", "Ann", "A", 95, "Insightful essay")
+        def fail(done, total):
+            raise RuntimeError("disk full")
+        
+        with pytest.raises(RuntimeError):
+            database.backup_database(str(tmp_path / "backup.db"), pages_per_step=1, progress=fail)
+        
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+        assert not os.path.exists(tmp_path / "backup.db")
+    
+    def test_create_backup_keeps_newest(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(database, "BACKUP_DIR", str(tmp_path / "backups"))
+        monkeypatch.setattr(database, "BACKUP_KEEP", 2)
+        for stamp in ["20240101-000000", "20240102-000000"]:
+            os.makedirs(database.BACKUP_DIR, exist_ok=True)
+            open(os.path.join(database.BACKUP_DIR, f"students-{stamp}.db"), "w").close()
+        
+        path = database.create_backup()
+        
+        assert sorted(os.listdir(database.BACKUP_DIR)) == ["students-20240102-000000.db", os.path.basename(path)]
+    
+    def test_snapshot_reads_are_isolated_and_read_only(self):
+        first = insert_record("T", "t@gmail.com", "Ann", "A", 95, "Insightful essay")
+        
+        # Without a snapshot, reads fall back to the live database
+        assert database.get_snapshot_time() is None
+        assert len(get_all_records(use_snapshot=True)) == 1
+        
+        database.refresh_snapshot()
+        insert_record("T", "t@gmail.com", "Bob", "B", 85, "Insightful too")
+        
+        assert [row[0] for row in get_all_records(use_snapshot=True)] == [first]
+        assert len(search_records("insightful", use_snapshot=True)) == 1
+        assert len(get_all_records()) == 2
+        
+        conn = database.connect_snapshot()
+        with pytest.raises(database.sqlite3.OperationalError):
+            conn.execute("DELETE FROM students")
+        conn.close()
+        
+        database.refresh_snapshot()
+        assert len(get_all_records(use_snapshot=True)) == 2
+
+# Worker for the multi-process load test: each process inserts rows into the shared file
+def _load_test_worker(db_path, worker_id, count):
+    database.DB_PATH = db_path
+    for i in range(count):
+        insert_record("T", f"t{worker_id}@gmail.com", f"S{worker_id}-{i}", "B", 80, "load test")
+
+# Test the storage backends and multi-process writers
+class TestStorage:
+    def test_unknown_backend_is_rejected(self):
+        with pytest.raises(ValueError):
+            storage.create_backend("nope", "students.db")
+    
+    def test_register_backend(self, monkeypatch):
+        monkeypatch.setitem(storage._BACKENDS, "custom", storage.SQLiteBackend)
+        monkeypatch.setattr(database, "DB_BACKEND", "custom")
+        assert isinstance(database.get_backend(), storage.SQLiteBackend)
+    
+    def test_wal_backend_settings(self, temp_db):
+        conn = connect_db()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 10000
+        assert conn.isolation_level == "IMMEDIATE"
+        conn.close()
+    
+    def test_write_queue_serves_in_order(self):
+        queue = storage.WriteQueue()
+        order = []
+        first_in = threading.Event()
+        release = threading.Event()
+        
+        def first():
+            with queue.turn():
+                first_in.set()
+                release.wait()
+                order.append("first")
+        
+        def later(name):
+            with queue.turn():
+                order.append(name)
+        
+        threads = [threading.Thread(target=first)]
+        threads[0].start()
+        first_in.wait()
+        for name in ["second", "third"]:
+            thread = threading.Thread(target=later, args=(name,))
+            thread.start()
+            threads.append(thread)
+            # Wait until the thread has taken its ticket before starting the next one
+            while queue.depth < len(threads):
+                pass
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        assert order == ["first", "second", "third"]
+        assert queue.depth == 0
+    
+    def test_lease_is_exclusive_until_expiry(self, temp_db):
+        assert database.acquire_lease("job", 60, owner="a")
+        assert not database.acquire_lease("job", 60, owner="b")
+        # The holder can renew its own lease
+        assert database.acquire_lease("job", 60, owner="a")
+        # An expired lease can be taken over
+        assert database.acquire_lease("job", -1, owner="a")
+        assert database.acquire_lease("job", 60, owner="b")
+    
+    def test_multi_process_load(self, temp_db):
+        # Several processes insert concurrently while this one runs bulk deletes
+        workers, per_worker = 4, 50
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=_load_test_worker, args=(temp_db, worker_id, per_worker))
+            for worker_id in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for _ in range(5):
+            database.clear_students_table()
+        for process in processes:
+            process.join(timeout=60)
+        
+        # No writer failed with "database is locked" and every row arrived
+        assert all(process.exitcode == 0 for process in processes)
+        assert len(database.find_record_ids(include_deleted=True)) == workers * per_worker
+
+# Test guarded PDF extraction in the sandboxed worker
+class TestPDFGuard:
+    # Write a PDF with one line of text per page
+    def _make_pdf(self, path, pages, line="Photosynthesis converts light into energy."):
+        import fitz
+        doc = fitz.open()
+        for _ in range(pages):
+            doc.new_page().insert_text((72, 72), line)
+        doc.save(str(path))
+        return str(path)
+    
+    def test_extracts_text(self, tmp_path):
+        text, truncated = pdf_guard.extract_text_guarded(self._make_pdf(tmp_path / "a.pdf", 2))
+        assert text.count("Photosynthesis") == 2
+        assert not truncated
+    
+    def test_truncates_at_token_budget(self, tmp_path):
+        text, truncated = pdf_guard.extract_text_guarded(self._make_pdf(tmp_path / "a.pdf", 50), max_tokens=25)
+        assert len(text) == 25 * pdf_guard.CHARS_PER_TOKEN
+        assert truncated
+    
+    def test_rejects_too_many_pages(self, tmp_path):
+        with pytest.raises(pdf_guard.PDFExtractionError, match="pages"):
+            pdf_guard.extract_text_guarded(self._make_pdf(tmp_path / "a.pdf", 5), max_pages=3)
+    
+    def test_rejects_large_file_without_parsing(self, tmp_path):
+        path = tmp_path / "big.pdf"
+        path.write_bytes(b"0" * 2048)
+        with pytest.raises(pdf_guard.PDFExtractionError, match="limit"):
+            pdf_guard.extract_text_guarded(str(path), max_bytes=1024)
+    
+    def test_reports_unreadable_file(self, tmp_path):
+        path = tmp_path / "broken.pdf"
+        path.write_bytes(b"not a pdf")
+        with pytest.raises(pdf_guard.PDFExtractionError):
+            pdf_guard.extract_text_guarded(str(path))
+    
+    def test_worker_does_not_rerun_the_main_script(self, tmp_path, monkeypatch):
+        # Under streamlit run, __main__ is app.py; the worker must not execute it again
+        marker = tmp_path / "main_ran"
+        script = tmp_path / "fake_app.py"
+        script.write_text(f"open({str(marker)!r}, 'w').close()\n")
+        fake_main = type(sys)("__main__")
+        fake_main.__file__ = str(script)
+        monkeypatch.setitem(sys.modules, "__main__", fake_main)
+        
+        text, _ = pdf_guard.extract_text_guarded(self._make_pdf(tmp_path / "a.pdf", 1))
+        
+        assert "Photosynthesis" in text
+        assert not marker.exists()
+    
+    def test_times_out_slow_worker(self, tmp_path):
+        with pytest.raises(pdf_guard.PDFExtractionError, match="timed out"):
+            pdf_guard.extract_text_guarded(self._make_pdf(tmp_path / "a.pdf", 1), page_timeout=0.001)
+
 # Test OpenAI utility functions
 class TestOpenAIUtils:
     # Mock the OpenAI client for all tests in this class
@@ -194,6 +616,467 @@ class TestOpenAIUtils:
         assert marks == 85
         assert remarks == "Good effort but needs improvement."
         
+# Test the incremental regrade planner against a real temporary database
+@pytest.mark.usefixtures("temp_db")
+class TestRegrade:
+    def test_only_stale_records_are_regraded(self):
+        current = dict(prompt_version="v2", routing_versions=["r-large", "r-cheap"])
+        fresh_id = insert_record("T", "t@gmail.com", "Fresh", "A", 90, "ok", submission_text="essay one",
+                                 content_hash=openai_utils.content_hash("essay one"),
+                                 prompt_version="v2", model="gpt-4o-mini", routing_version="r-cheap")
+        old_a = insert_record("T", "t@gmail.com", "OldA", "B", 85, "ok", submission_text="shared template",
+                              prompt_version="v1", model="gpt-4o", routing_version="r-large")
+        old_b = insert_record("T", "t@gmail.com", "OldB", "C", 75, "ok", submission_text="shared template")
+        no_text = insert_record("T", "t@gmail.com", "NoText", "B", 80, "ok")
+        
+        # The cheap count shown in the admin panel agrees with the full plan
+        assert database.count_stale_records(**current) == (2, 1)
+        
+        plan = regrade.plan_regrade(**current)
+        
+        # Identical texts are grouped into one job; rows without text are reported
+        assert len(plan["jobs"]) == 1
+        assert [row[0] for job in plan["jobs"].values() for row in job["records"]] == [old_a, old_b]
+        assert plan["missing_text"] == [no_text]
+        
+        calls = []
+        def stub_grader(text, **scheduling):
+            calls.append(text)
+            return "B", 88, "Regraded", {"prompt_version": "v2", "model": "gpt-4o", "routing_version": "r-large"}
+        
+        report = regrade.run_regrade(plan, grader=stub_grader, min_interval_seconds=0)
+        
+        assert calls == ["shared template"]
+        assert {row["id"]: (row["old_grade"], row["new_grade"], row["marks_change"], row["grade_changed"])
+                for row in report} == {old_a: ("B", "B", 3, False), old_b: ("C", "B", 13, True)}
+        
+        # Regraded rows are no longer stale and the untouched row kept its grade
+        assert [row[0] for row in database.get_stale_records(**current)] == [no_text]
+        assert get_all_records()[0][:6] == (fresh_id, "T", "t@gmail.com", "Fresh", "A", 90)
+    
+    def test_failed_call_does_not_discard_other_results(self):
+        ids = [insert_record("T", "t@gmail.com", f"S{i}", "C", 70, "ok", submission_text=f"essay {i}")
+               for i in range(6)]
+        metadata = {"prompt_version": "v2", "model": "gpt-4o", "routing_version": "r-large"}
+        def flaky_grader(text, **scheduling):
+            if text == "essay 2":
+                raise RuntimeError("rate limited")
+            return "B", 85, "Regraded", metadata
+        
+        plan = regrade.plan_regrade("v2", ["r-large"])
+        report = regrade.run_regrade(plan, grader=flaky_grader, batch_size=3, min_interval_seconds=0)
+        
+        # Every successful result is written; the failed record is reported and stays stale
+        assert [row["id"] for row in report] == ids
+        assert [row["id"] for row in report if row["error"]] == [ids[2]]
+        assert report[2]["error"] == "rate limited"
+        assert [row[0] for row in database.get_stale_records("v2", ["r-large"])] == [ids[2]]
+    
+    def test_records_store_the_model_that_graded_them(self, monkeypatch):
+        monkeypatch.setattr(openai_utils, "ROUTER_ENABLED", True)
+        monkeypatch.setattr(openai_utils, "_grading_flight", SingleFlight())
+        monkeypatch.setattr(openai_utils.grading_router, "grade",
+                            lambda text, messages: ("B", 85, "Solid", "cheap"))
+        
+        grade, marks, remarks, grading = openai_utils.grade_assignment_routed("short essay")
+        record_id = insert_record("T", "t@gmail.com", "Ann", grade, marks, remarks,
+                                  submission_text="short essay", **grading)
+        
+        assert grading["model"] == openai_utils.ROUTER_CHEAP_MODEL
+        assert regrade.plan_regrade()["jobs"] == {}
+        
+        # Changing the cheap model's settings makes exactly its grades stale
+        monkeypatch.setattr(openai_utils, "ROUTER_CONFIDENCE_MARGIN", openai_utils.ROUTER_CONFIDENCE_MARGIN + 1)
+        large_id = insert_record("T", "t@gmail.com", "Bob", "A", 95, "ok", submission_text="long essay",
+                                 **openai_utils.grading_metadata("large"))
+        stale = database.get_stale_records(openai_utils.GRADING_PROMPT_VERSION,
+                                           openai_utils.current_routing_versions())
+        assert [row[0] for row in stale] == [record_id]
+        
+        # Turning routing off leaves large-model grades current
+        monkeypatch.setattr(openai_utils, "ROUTER_ENABLED", False)
+        assert database.count_stale_records(openai_utils.GRADING_PROMPT_VERSION,
+                                            openai_utils.current_routing_versions()) == (1, 0)
+        assert large_id not in [row[0] for row in database.get_stale_records(
+            openai_utils.GRADING_PROMPT_VERSION, openai_utils.current_routing_versions())]
+    
+    def test_text_loader_fills_missing_text(self):
+        record_id = insert_record("T", "t@gmail.com", "NoText", "B", 80, "ok")
+        
+        plan = regrade.plan_regrade("v2", ["r-large"], text_loader=lambda rid: f"re-extracted {rid}")
+        
+        assert plan["missing_text"] == []
+        assert list(plan["jobs"].values())[0]["text"] == f"re-extracted {record_id}"
+
+# Test the offline batch grading pipeline with the local file-based provider
+@pytest.mark.usefixtures("temp_db")
+class TestBatchGrading:
+    def _submissions(self, count):
+        return [{"teacher_name": "T", "teacher_email": "t@bu.edu", "student_name": f"S{i}", "text": f"essay {i}"}
+                for i in range(count)]
+    
+    def _responder(self, body):
+        # Reply based on the essay number at the end of the prompt
+        number = int(body["messages"][1]["content"].split("essay ")[1].split()[0])
+        return f"Grade: B\nMarks: {80 + number}\nRemarks: Essay {number} reviewed"
+    
+    def test_batch_file_format(self, tmp_path):
+        path = str(tmp_path / "in.jsonl")
+        batch_grading.write_batch_file([{"custom_id": "item-0", "submission_text": "essay 0"}], path)
+        
+        request = json.loads(open(path).read())
+        assert request["custom_id"] == "item-0"
+        assert request["url"] == "/v1/chat/completions"
+        assert request["body"]["model"] == openai_utils.GRADING_MODEL
+        assert request["body"]["messages"] == openai_utils.build_grading_messages("essay 0")
+    
+    def test_submit_poll_collect_is_resumable(self, tmp_path):
+        adapter = batch_grading.LocalBatchAdapter(str(tmp_path / "provider"), self._responder)
+        batch_id = batch_grading.submit_grading_batch(self._submissions(3), adapter, work_dir=str(tmp_path))
+        
+        assert batch_grading.wait_for_batch(batch_id, adapter, poll_seconds=0) == "completed"
+        assert batch_grading.collect_grading_batch(batch_id, adapter) == {"inserted": 3, "failed": []}
+        assert [row[3:6] for row in get_all_records()] == [("S0", "B", 80), ("S1", "B", 81), ("S2", "B", 82)]
+        
+        # Collecting again (e.g. after a crash) does not duplicate records
+        assert batch_grading.collect_grading_batch(batch_id, adapter)["inserted"] == 0
+        assert len(get_all_records()) == 3
+        assert database.get_unfinished_grading_batches() == []
+        
+        # Records carry the grading version, so they are not stale
+        assert database.get_stale_records(openai_utils.GRADING_PROMPT_VERSION,
+                                          openai_utils.current_routing_versions()) == []
+    
+    def _fail_item(self, adapter, batch_id, custom_id):
+        # Make the provider report an error for one request of a batch
+        output_path = adapter._output_path(database.get_grading_batch(batch_id)[1])
+        lines = open(output_path).read().splitlines()
+        index = next(i for i, line in enumerate(lines) if json.loads(line)["custom_id"] == custom_id)
+        lines[index] = json.dumps({"custom_id": custom_id, "response": None, "error": {"message": "rate limited"}})
+        open(output_path, "w").write("\n".join(lines))
+    
+    def test_failed_items_are_resubmitted(self, tmp_path):
+        adapter = batch_grading.LocalBatchAdapter(str(tmp_path / "provider"), self._responder)
+        batch_id = batch_grading.submit_grading_batch(self._submissions(2), adapter, work_dir=str(tmp_path))
+        self._fail_item(adapter, batch_id, "item-1")
+        
+        summary = batch_grading.resume_grading_batches(adapter, poll_seconds=0, work_dir=str(tmp_path))
+        
+        # The failed item is sent again in a new batch; the old batch is finished
+        assert summary["batches"] == {batch_id: {"inserted": 1, "failed": ["item-1"]}}
+        retry_id = summary["retry_batch_id"]
+        assert [row[0] for row in database.get_unfinished_grading_batches()] == [retry_id]
+        
+        summary = batch_grading.resume_grading_batches(adapter, poll_seconds=0, work_dir=str(tmp_path))
+        assert summary == {"batches": {retry_id: {"inserted": 1, "failed": []}},
+                           "retry_batch_id": None, "exhausted": []}
+        assert sorted(row[3] for row in get_all_records()) == ["S0", "S1"]
+        assert database.get_unfinished_grading_batches() == []
+    
+    def test_items_are_given_up_after_max_attempts(self, tmp_path):
+        adapter = batch_grading.LocalBatchAdapter(str(tmp_path / "provider"), self._responder)
+        batch_id = batch_grading.submit_grading_batch(self._submissions(2), adapter, work_dir=str(tmp_path))
+        self._fail_item(adapter, batch_id, "item-1")
+        
+        summary = batch_grading.resume_grading_batches(adapter, poll_seconds=0, max_attempts=1,
+                                                       work_dir=str(tmp_path))
+        
+        # The item reaches a terminal state instead of being polled forever
+        assert summary["retry_batch_id"] is None
+        assert summary["exhausted"] == [(batch_id, "item-1")]
+        assert database.get_unfinished_grading_batches() == []
+    
+    def test_batch_is_saved_before_it_is_submitted(self, tmp_path):
+        adapter = batch_grading.LocalBatchAdapter(str(tmp_path / "provider"), self._responder)
+        
+        # The process stops while the batch is being sent to the provider
+        class Crash(Exception):
+            pass
+        def crash(input_path):
+            raise Crash()
+        with patch.object(adapter, "submit", crash), pytest.raises(Crash):
+            batch_grading.submit_grading_batch(self._submissions(2), adapter, work_dir=str(tmp_path))
+        
+        # The items and input file were saved, so resume can send the batch
+        [(batch_id, input_path)] = database.get_pending_grading_batches()
+        assert os.path.exists(input_path)
+        
+        summary = batch_grading.resume_grading_batches(adapter, poll_seconds=0, work_dir=str(tmp_path))
+        assert summary["batches"] == {batch_id: {"inserted": 2, "failed": []}}
+        assert database.get_pending_grading_batches() == []
+
+# Test the cheap-first model router with stub backends
+class TestModelRouter:
+    def _router(self, replies):
+        # Stub backend answering per model and recording which models were called
+        calls = []
+        def backend(model, messages, max_tokens):
+            calls.append(model)
+            reply = replies[model]
+            if isinstance(reply, Exception):
+                raise reply
+            return reply, 1000, 100
+        router = ModelRouter(
+            backend, openai_utils.parse_grading_response,
+            cheap=Route("cheap", "mini", 200, input_price=0.1, output_price=0.2),
+            large=Route("large", "big", 300, input_price=1.0, output_price=2.0),
+            short_text_chars=100, confidence_margin=2
+        )
+        return router, calls
+    
+    def test_escalation_rules(self):
+        assert needs_escalation("B", 85, "Good", 2) is None
+        assert needs_escalation("N/A", 85, "Good", 2) == "invalid grade"
+        assert needs_escalation("B", 150, "Good", 2) == "invalid marks"
+        assert needs_escalation("B", 85, "No remarks provided.", 2) == "missing remarks"
+        assert needs_escalation("A", 72, "Good", 2) == "grade does not match marks"
+        assert needs_escalation("B", 81, "Good", 2) == "marks near a grade boundary"
+    
+    def _escalation_rate(self, margin):
+        # Share of realistic marks (50-100) escalated when grade and marks agree
+        marks = range(50, 101)
+        escalated = [m for m in marks if needs_escalation(expected_grade(m), m, "Good", margin)]
+        return len(escalated) / len(marks)
+    
+    def test_default_margin_keeps_escalation_rate_low(self):
+        assert openai_utils.ROUTER_CONFIDENCE_MARGIN == openai_utils.grading_router.confidence_margin == 0
+        
+        # Only marks exactly on a boundary (60, 70, 80, 90) are escalated by default
+        assert self._escalation_rate(0) == pytest.approx(4 / 51)
+        assert self._escalation_rate(0) < 0.1
+        # A margin of 2 would send about 40% of results to the large model
+        assert self._escalation_rate(2) > 0.35
+    
+    def test_prompt_states_the_grade_scale_that_is_checked(self):
+        # The mismatch check is only fair if the model was told the scale
+        prompt = openai_utils.build_grading_prompt("essay")
+        for lowest, grade in GRADE_BANDS:
+            assert f"{grade} = {lowest}-" in prompt
+    
+    def test_short_confident_result_stays_on_cheap_model(self):
+        router, calls = self._router({"mini": "Grade: B\nMarks: 85\nRemarks: Solid"})
+        
+        assert router.grade("short answer", []) == ("B", 85, "Solid", "cheap")
+        assert calls == ["mini"]
+        stats = router.stats()
+        assert stats["cheap"]["calls"] == 1
+        assert stats["cheap"]["cost_usd"] == pytest.approx(0.12)
+        assert stats["large"]["calls"] == 0
+    
+    def test_low_confidence_or_failure_escalates(self):
+        router, calls = self._router({"mini": "Grade: B\nMarks: 80\nRemarks: Borderline",
+                                      "big": "Grade: C\nMarks: 78\nRemarks: Careful review"})
+        assert router.grade("short answer", []) == ("C", 78, "Careful review", "large")
+        assert calls == ["mini", "big"]
+        
+        router, calls = self._router({"mini": RuntimeError("timeout"), "big": "Grade: A\nMarks: 95\nRemarks: Great"})
+        assert router.grade("short answer", [])[3] == "large"
+        stats = router.stats()
+        assert stats["cheap"]["errors"] == 1
+        assert stats["cheap"]["escalation_rate"] == 1.0
+    
+    def test_long_submission_goes_to_large_model(self):
+        router, calls = self._router({"big": "Grade: A\nMarks: 95\nRemarks: Great"})
+        router.grade("x" * 101, [])
+        assert calls == ["big"]
+        assert router.stats()["cheap"]["escalations"] == 0
+
+# Test fair-share scheduling of grading calls across teachers
+class TestFairShareScheduler:
+    # Occupy every worker until the returned event is set, so the queue order can be observed
+    def _block_workers(self, scheduler, count):
+        gate = threading.Event()
+        futures = [scheduler.submit(f"blocker{i}", gate.wait) for i in range(count)]
+        while sum(stats["running"] for stats in scheduler.stats().values()) < count:
+            time.sleep(0.01)
+        return gate, futures
+    
+    def test_bulk_backlog_does_not_starve_other_teachers(self):
+        scheduler = FairShareScheduler(capacity=1, per_teacher_limit=1)
+        gate, _ = self._block_workers(scheduler, 1)
+        order = []
+        futures = [scheduler.submit("bulk@bu.edu", lambda i=i: order.append(f"bulk{i}"), interactive=False)
+                   for i in range(10)]
+        futures.append(scheduler.submit("other@bu.edu", lambda: order.append("other"), interactive=False))
+        futures.append(scheduler.submit("late@bu.edu", lambda: order.append("interactive")))
+        
+        stats = scheduler.stats()
+        assert stats["bulk@bu.edu"]["queued_bulk"] == 10
+        assert stats["late@bu.edu"]["queued_interactive"] == 1
+        
+        gate.set()
+        for future in futures:
+            future.result(timeout=5)
+        scheduler.shutdown()
+        
+        # Interactive work goes first, and the single bulk job is not stuck behind the backlog
+        assert order[0] == "interactive"
+        assert order.index("other") <= 2
+    
+    def test_per_teacher_concurrency_cap(self):
+        scheduler = FairShareScheduler(capacity=4, per_teacher_limit=2)
+        lock = threading.Lock()
+        running = [0, 0]
+        def job():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        
+        futures = [scheduler.submit("busy@bu.edu", job) for _ in range(6)]
+        for future in futures:
+            future.result(timeout=5)
+        scheduler.shutdown()
+        
+        assert running[1] == 2
+        assert scheduler.stats()["busy@bu.edu"]["started"] == 6
+    
+    def test_errors_are_returned_to_the_caller(self):
+        scheduler = FairShareScheduler(capacity=1)
+        def failing():
+            raise RuntimeError("quota exceeded")
+        with pytest.raises(RuntimeError, match="quota"):
+            scheduler.run("t@bu.edu", failing)
+        assert scheduler.run("t@bu.edu", lambda: "ok") == "ok"
+        scheduler.shutdown()
+    
+    def test_base_exceptions_do_not_kill_workers(self):
+        scheduler = FairShareScheduler(capacity=1, per_teacher_limit=1)
+        class Abort(BaseException):
+            pass
+        def aborting():
+            raise Abort()
+        
+        # The caller gets the error instead of waiting forever
+        with pytest.raises(Abort):
+            scheduler.submit("t@bu.edu", aborting).result(timeout=5)
+        
+        # The only worker is still alive and the teacher's slot was released
+        assert scheduler.submit("t@bu.edu", lambda: "ok").result(timeout=5) == "ok"
+        assert scheduler.stats()["t@bu.edu"]["running"] == 0
+        scheduler.shutdown()
+
+# Test single-flight coalescing of identical in-flight calls
+class TestSingleFlight:
+    def _run_concurrently(self, count, target):
+        results = [None] * count
+        errors = [None] * count
+        def run(index):
+            try:
+                results[index] = target()
+            except BaseException as error:
+                errors[index] = error
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+    
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+        
+        results, _ = self._run_concurrently(5, lambda: flight.do("key", slow))
+        
+        assert calls == [1]
+        assert results == ["result"] * 5
+        assert flight.stats() == {"executed": 1, "coalesced": 4, "in_flight": 0}
+        
+        # Once finished nothing is cached: the next call runs again
+        flight.do("key", slow)
+        assert len(calls) == 2
+    
+    def test_errors_are_shared_and_not_cached(self):
+        flight = SingleFlight()
+        def failing():
+            time.sleep(0.2)
+            raise RuntimeError("boom")
+        
+        _, errors = self._run_concurrently(3, lambda: flight.do("key", failing))
+        
+        assert all(isinstance(error, RuntimeError) for error in errors)
+        assert flight.do("key", lambda: "ok") == "ok"
+    
+    def test_base_exceptions_are_shared(self):
+        # e.g. KeyboardInterrupt in the leader must not hand followers a None result
+        class Abort(BaseException):
+            pass
+        flight = SingleFlight()
+        def aborting():
+            time.sleep(0.2)
+            raise Abort()
+        
+        results, errors = self._run_concurrently(3, lambda: flight.do("key", aborting))
+        
+        assert results == [None] * 3
+        assert all(isinstance(error, Abort) for error in errors)
+    
+    def test_grade_assignment_coalesces_threads_and_tasks(self, monkeypatch):
+        monkeypatch.setattr(openai_utils, "_grading_flight", SingleFlight())
+        calls = []
+        def slow_grade(text):
+            calls.append(text)
+            time.sleep(0.2)
+            return "A", 95, "Great"
+        monkeypatch.setattr(openai_utils, "_grade_assignment", slow_grade)
+        
+        async def grade_many():
+            return await asyncio.gather(*[openai_utils.grade_assignment_async("template") for _ in range(4)])
+        
+        results = asyncio.run(grade_many())
+        
+        assert calls == ["template"]
+        assert results == [("A", 95, "Great")] * 4
+        assert openai_utils.get_coalescing_stats()["grade_assignment"]["coalesced"] == 3
+
+# Test that coalescing happens before fair-share queueing
+class TestCoalescingWithScheduler:
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.scheduler = FairShareScheduler(capacity=4, per_teacher_limit=2)
+        self.calls = []
+        def slow_grade(text):
+            self.calls.append(text)
+            time.sleep(0.3)
+            return "A", 95, "Great", openai_utils.grading_metadata("large")
+        monkeypatch.setattr(openai_utils, "grading_scheduler", self.scheduler)
+        monkeypatch.setattr(openai_utils, "_grading_flight", SingleFlight())
+        monkeypatch.setattr(openai_utils, "_grade_assignment", slow_grade)
+        yield
+        self.scheduler.shutdown()
+    
+    def _grade_concurrently(self, teachers):
+        results = [None] * len(teachers)
+        def run(index):
+            results[index] = openai_utils.grade_assignment_routed("shared template", teacher=teachers[index])
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(teachers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def test_one_teacher_past_the_cap_shares_one_call(self):
+        results = self._grade_concurrently(["t@bu.edu"] * 6)
+        
+        assert self.calls == ["shared template"]
+        assert all(result[:3] == ("A", 95, "Great") for result in results)
+    
+    def test_many_teachers_share_one_call_and_one_slot(self):
+        results = self._grade_concurrently([f"t{i}@bu.edu" for i in range(6)])
+        
+        assert self.calls == ["shared template"]
+        assert len(results) == 6
+        # Only the leader queued in the scheduler
+        assert sum(stats["started"] for stats in self.scheduler.stats().values()) == 1
+
 # Test email validation function 
 class TestEmailValidation:
     def test_valid_gmail(self):